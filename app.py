@@ -1,9 +1,35 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import atexit
+import bisect
+import click
+import csv
+import functools
+import gzip
+import io
 import json
 import os
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import urllib.request
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+# 可选依赖：orjson 用于紧凑格式的 JSON 编码，brotli 用于 br 响应压缩
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -11,22 +37,592 @@ CORS(app, resources={r"/api/*": {"origins": "*"}})
 # Render 会自动设置 PORT 环境变量
 PORT = int(os.environ.get('PORT', 5000))
 
-# 数据库文件路径
-DB_PATH = os.path.join(os.path.dirname(__file__), 'warehouse.db')
+# 数据库文件路径（WAREHOUSE_DB 可指定其他文件，例如基准测试生成的数据库）
+DB_PATH = os.environ.get('WAREHOUSE_DB', os.path.join(os.path.dirname(__file__), 'warehouse.db'))
 
+# 历史记录归档库路径（以 archive 名称 ATTACH 到主库连接上），默认与主库放在一起
+ARCHIVE_DB_PATH = os.environ.get('WAREHOUSE_ARCHIVE', os.path.splitext(DB_PATH)[0] + '_archive.db')
 
-def get_db_connection():
-    """获取数据库连接"""
-    conn = sqlite3.connect(DB_PATH)
+# 只读快照（报表、导出、统计可加 snapshot=1 读取）：快照文件路径、自动刷新间隔（秒，0 表示只在请求时生成）、
+# 在线备份每步复制的页数、每步之间的停顿（秒）
+SNAPSHOT_PATH = os.environ.get('WAREHOUSE_SNAPSHOT', os.path.splitext(DB_PATH)[0] + '_snapshot.db')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 0))
+SNAPSHOT_PAGES = 1024
+SNAPSHOT_STEP_PAUSE = 0.01
+
+# 历史记录保留天数，archive-history 未指定 --days 时使用
+HISTORY_RETENTION_DAYS = int(os.environ.get('HISTORY_RETENTION_DAYS', 180))
+
+# 每个连接打开时设置一次的 SQLite 参数
+DB_PRAGMAS = [
+    ("auto_vacuum", "INCREMENTAL"),   # 只对新建数据库生效，已有数据库需执行一次 archive-history --vacuum
+    ("journal_mode", "WAL"),          # 读写互不阻塞
+    ("synchronous", "NORMAL"),        # WAL 模式下只在检查点时 fsync
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -64 * 1024),       # 负数单位为 KiB，即 64MB
+    ("busy_timeout", 5000),           # 写锁被占用时最多等待 5 秒
+]
+
+# 线程内连接超过该秒数未使用时，取用前先做一次健康检查
+DB_HEALTH_CHECK_INTERVAL = 30
+
+# 货物字段（fields= 投影可选的字段，_id/stock 为兼容小程序的别名）
+GOODS_FIELDS = [
+    "id", "_id", "name", "sku", "price", "location", "quantity", "stock",
+    "min_quantity", "description", "created_at", "updated_at"
+]
+
+# 紧凑格式（format=columnar）可返回的货物、历史记录列，不含 _id/stock/time 别名
+GOODS_COMPACT_FIELDS = [f for f in GOODS_FIELDS if f not in ("_id", "stock")]
+HISTORY_COMPACT_FIELDS = ["id", "goods_id", "goods_name", "operation_type", "quantity", "notes", "timestamp"]
+
+# 响应压缩：是否启用、小于该字节数的响应不压缩（流式响应大小未知，总是压缩）、
+# 压缩的内容类型、gzip 压缩级别、brotli 压缩质量
+COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') != '0'
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# 货物列表分页：默认每页条数与上限
+GOODS_PAGE_SIZE = 50
+GOODS_PAGE_MAX = 500
+
+# 出现以下任一参数时 /api/goods 走分页查询，否则保持旧的全量返回
+GOODS_PAGE_PARAMS = ('after_id', 'limit', 'location', 'min_price', 'max_price', 'low_stock', 'fields')
+
+# UPDATE ... RETURNING 返回的货物列（SQLite 3.40 及以前 RETURNING 会把整数值的 REAL 返回成整数）
+GOODS_RETURNING = (
+    "id, name, sku, CAST(price AS REAL) AS price, location, quantity, stock, "
+    "min_quantity, description, created_at, updated_at"
+)
+
+# 新增货物的必填字段
+GOODS_REQUIRED_FIELDS = ['name', 'price', 'location']
+
+# 导入/导出：CSV 列顺序、每个事务导入的行数、导出时每次读取的行数、最多返回的错误行数
+EXPORT_FIELDS = [
+    "id", "name", "price", "location", "quantity", "min_quantity",
+    "description", "created_at", "updated_at", "sku"
+]
+IMPORT_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+
+# 货物缓存：最多缓存的条目数和总字节数（超过上限的货物列表直接流式返回，不缓存）
+GOODS_CACHE_MAX_ENTRIES = 4096
+GOODS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# 增量同步：参与同步的表，以及每次同步返回的默认/最大变更数
+SYNC_TABLES = ("goods", "history")
+SYNC_PAGE_SIZE = 1000
+SYNC_PAGE_MAX = 5000
+
+# 实时事件（SSE）：每个进程的事件缓冲区大小、轮询事件表的间隔（秒）、心跳间隔（秒）、
+# 事件表保留的事件数、清理事件表的间隔（秒）、每个进程的最大订阅连接数
+# （gunicorn 下每个订阅连接占用一个线程，gunicorn.conf.py 会把上限调到线程数以下）
+EVENTS_BUFFER_SIZE = 1000
+EVENTS_POLL_INTERVAL = 0.5
+EVENTS_KEEPALIVE = 15
+EVENTS_RETENTION = 10000
+EVENTS_PRUNE_INTERVAL = 60
+EVENTS_MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', 100))
+
+# 历史记录分页：默认每页条数与上限；出现任一筛选参数时 /api/history 走分页查询
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 500
+HISTORY_PAGE_PARAMS = ('from', 'to', 'op', 'cursor', 'limit', 'goods_id', 'archived')
+
+# 批量删除/归档：每批处理的历史记录数、批次之间让出写锁的时间（秒）、每次增量 VACUUM 释放的页数
+BULK_BATCH_SIZE = 1000
+BULK_BATCH_PAUSE = 0.05
+ARCHIVE_VACUUM_PAGES = 2000
+
+# 后台任务心跳间隔（秒）；超过租约时间没有心跳的运行中任务视为执行进程已退出
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_LEASE_SECONDS = 60
+
+# 按 _id 批量获取货物时单次最多的 id 数
+GOODS_BATCH_MAX = 500
+
+# 扫码查询：SKU 最大长度、内存中 SKU -> 货物 id 映射最多保留的条数
+SKU_MAX_LENGTH = 64
+SKU_INDEX_MAX_ENTRIES = 100000
+
+# 批量库存操作：单批最大行数，以及 op 到历史记录操作类型的映射
+STOCK_BATCH_MAX = 1000
+STOCK_BATCH_OPS = {"in": "入库", "out": "出库", "stock_in": "入库", "stock_out": "出库"}
+
+# 单次入库/出库合并提交（默认关闭）：开启后由一个写线程收集时间窗口（毫秒）内到达的请求，
+# 最多合并多少个，在一个事务中执行并提交；每个请求仍得到各自的结果
+STOCK_GROUP_COMMIT = os.environ.get('STOCK_GROUP_COMMIT', '0') == '1'
+STOCK_GROUP_WINDOW_MS = float(os.environ.get('STOCK_GROUP_WINDOW_MS', 3))
+STOCK_GROUP_MAX = int(os.environ.get('STOCK_GROUP_MAX', 200))
+
+# 低库存告警：通知投递地址（为空时不投递）、告警解除后多少秒内再次低库存视为抖动（重新打开原告警，不再通知）、
+# 投递轮询间隔（秒）、失败重试的最大间隔（秒）
+ALERT_WEBHOOK_URL = os.environ.get('ALERT_WEBHOOK_URL', '')
+ALERT_DEBOUNCE_SECONDS = int(os.environ.get('ALERT_DEBOUNCE_SECONDS', 300))
+ALERT_DISPATCH_INTERVAL = 1.0
+ALERT_RETRY_MAX_DELAY = 300
+
+# 全文检索表：表名 -> (检索表名, 被索引的列)
+SEARCH_INDEXES = {
+    "goods": ("goods_fts", "name"),
+    "history": ("history_fts", "goods_name"),
+}
+
+# trigram 分词至少需要3个字符，更短的关键词退回 LIKE 扫描
+SEARCH_MIN_TRIGRAM = 3
+
+# 当前 SQLite 是否支持 FTS5，由 init_search_index() 检测
+FTS_ENABLED = False
+
+# 监控指标：是否启用（/metrics）、慢查询阈值（毫秒，记录日志并附带 EXPLAIN QUERY PLAN）
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+# 直方图分桶：耗时（秒）、每个请求读取的行数
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# 指标名 -> (类型, 说明)
+METRIC_HELP = {
+    "warehouse_http_requests_total": ("counter", "HTTP requests by route and status"),
+    "warehouse_http_request_duration_seconds": ("histogram", "Request latency including streamed body"),
+    "warehouse_http_response_bytes_total": ("counter", "Response body bytes"),
+    "warehouse_request_rows": ("histogram", "Rows fetched from SQLite per request"),
+    "warehouse_request_sql_seconds_total": ("counter", "Time spent executing SQL per route"),
+    "warehouse_request_json_seconds_total": ("counter", "Time spent serializing JSON per route"),
+    "warehouse_sql_statements_total": ("counter", "Statements run by SQLite (trace callback), including triggers"),
+    "warehouse_sql_duration_seconds": ("histogram", "Statement execution time by statement type"),
+    "warehouse_slow_queries_total": ("counter", "Statements slower than SLOW_QUERY_MS"),
+    "warehouse_db_connection_open_seconds": ("histogram", "Time to open and configure a connection"),
+    "warehouse_db_connections": ("gauge", "Open SQLite connections in this process"),
+    "warehouse_stock_group_commit_size": ("histogram", "Stock movements committed per group commit transaction"),
+}
+
+
+class GoodsCache:
+    """按货物表修改代数整体失效的 LRU 缓存，缓存序列化后的响应体"""
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = -1
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+    
+    def get(self, generation, key):
+        with self.lock:
+            if generation != self.generation or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+    
+    def put(self, generation, key, body):
+        with self.lock:
+            # 代数落后的结果（读取期间已有新的修改）不再缓存
+            if generation < self.generation or len(body) > self.max_bytes:
+                return
+            if generation > self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+            
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = body
+            self.size += len(body)
+            
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+goods_cache = GoodsCache(GOODS_CACHE_MAX_ENTRIES, GOODS_CACHE_MAX_BYTES)
+
+
+class SkuIndex:
+    """SKU -> 货物 id 的内存映射（LRU），扫码时先按映射用主键取行
+    
+    映射只用于加速，不保证最新：其他进程修改或删除货物后，取到的行 SKU 不一致或不存在，
+    此时改用 SKU 索引查询并修正映射。
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, code):
+        with self.lock:
+            goods_id = self.entries.get(code)
+            if goods_id is not None:
+                self.entries.move_to_end(code)
+            return goods_id
+    
+    def put(self, code, goods_id):
+        with self.lock:
+            self.entries[code] = goods_id
+            self.entries.move_to_end(code)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def discard(self, code):
+        with self.lock:
+            self.entries.pop(code, None)
+
+
+sku_index = SkuIndex(SKU_INDEX_MAX_ENTRIES)
+
+
+# ============ 监控指标 ============
+
+class Metrics:
+    """进程内的计数器和直方图，以 Prometheus 文本格式输出（多进程部署时每个进程各自统计）"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+    
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+    
+    def observe(self, name, buckets, labels, value):
+        with self.lock:
+            entry = self.histograms.get((name, labels))
+            if entry is None:
+                # 每个桶的计数（最后一个为 +Inf）、总和
+                entry = self.histograms[name, labels] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            entry[1][bisect.bisect_left(buckets, value)] += 1
+            entry[2] += value
+    
+    def render(self, gauges=()):
+        """输出 Prometheus 文本格式"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (b, list(c), s)) for key, (b, c, s) in self.histograms.items())
+        samples = {}
+        for (name, labels), value in counters:
+            samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), (buckets, counts, total) in histograms:
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}' if bound != '+Inf' else bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for name, value in gauges:
+            samples.setdefault(name, []).append(f"{name} {value}")
+        
+        output = []
+        for name, lines in samples.items():
+            kind, help_text = METRIC_HELP.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+def format_labels(labels):
+    """格式化标签，值中的反斜杠、引号和换行需要转义"""
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+metrics = Metrics()
+
+
+class RequestStats:
+    """当前请求累计的 SQL 耗时、读取行数和 JSON 序列化耗时（线程内累加，请求结束时一次性记入指标）"""
+    __slots__ = ('sql_seconds', 'rows', 'json_seconds')
+    
+    def __init__(self):
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.json_seconds = 0.0
+
+
+def statement_type(sql):
+    """语句类型（SELECT/INSERT/...），用作指标标签；触发器内的语句由 trace 回调以注释形式给出"""
+    head = sql.lstrip()[:10].split(None, 1)
+    if not head:
+        return "OTHER"
+    if head[0].startswith('--'):
+        return "TRIGGER"
+    kind = head[0].upper()
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK",
+                            "PRAGMA", "CREATE", "REPLACE", "EXPLAIN") else "OTHER"
+
+
+def trace_statement(sql):
+    """sqlite3 trace 回调：统计实际执行的语句数（包括触发器中的语句）"""
+    metrics.inc("warehouse_sql_statements_total", (("statement", statement_type(sql)),))
+
+
+def record_sql(conn, sql, params, elapsed):
+    """记录一条语句的耗时；超过慢查询阈值时记录日志和执行计划"""
+    kind = statement_type(sql)
+    metrics.observe("warehouse_sql_duration_seconds", LATENCY_BUCKETS, (("statement", kind),), elapsed)
+    stats = getattr(_local, 'request_stats', None)
+    if stats is not None:
+        stats.sql_seconds += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS and kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        metrics.inc("warehouse_slow_queries_total", (("statement", kind),))
+        try:
+            plan = [row[3] for row in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params or ())]
+        except sqlite3.Error:
+            plan = []
+        app.logger.warning("慢查询 %.1f ms: %s\n    %s", elapsed * 1000, ' '.join(sql.split()),
+                           '\n    '.join(plan) or '(无执行计划)')
+
+
+def count_rows(count):
+    """把读取的行数计入当前请求"""
+    stats = getattr(_local, 'request_stats', None)
+    if stats is not None:
+        stats.rows += count
+
+
+class TimedCursor(sqlite3.Cursor):
+    """记录语句耗时和读取行数的游标"""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(self.connection, sql, parameters, time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(self.connection, sql, None, time.perf_counter() - start)
+    
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            count_rows(1)
+        return row
+    
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        count_rows(len(rows))
+        return rows
+    
+    def fetchall(self):
+        rows = super().fetchall()
+        count_rows(len(rows))
+        return rows
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """把 JSON 序列化耗时计入当前请求"""
+    
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            record_json_time(start)
+
+
+def record_json_time(start):
+    """把从 start 开始的 JSON 序列化耗时计入当前请求"""
+    stats = getattr(_local, 'request_stats', None)
+    if stats is not None:
+        stats.json_seconds += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """WSGI 中间件：统计每个请求的耗时、响应字节数等，流式响应在响应体发送完毕时统计"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        stats = _local.request_stats = RequestStats()
+        status = []
+        
+        def record_status(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+        
+        body = self.wsgi_app(environ, record_status)
+        return MeteredBody(body, environ, status, start, stats)
+
+
+class MeteredBody:
+    """包装响应体，统计字节数，关闭时把整个请求记入指标"""
+    
+    def __init__(self, body, environ, status, start, stats):
+        self.body = body
+        self.environ = environ
+        self.status = status
+        self.start = start
+        self.stats = stats
+        self.size = 0
+    
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if getattr(_local, 'request_stats', None) is self.stats:
+                _local.request_stats = None
+            route = (("method", self.environ.get("REQUEST_METHOD", "")),
+                     ("route", self.environ.get("warehouse.route", "<unmatched>")))
+            metrics.inc("warehouse_http_requests_total", route + (("status", self.status[0] if self.status else ""),))
+            metrics.observe("warehouse_http_request_duration_seconds", LATENCY_BUCKETS, route,
+                            time.perf_counter() - self.start)
+            metrics.inc("warehouse_http_response_bytes_total", route, self.size)
+            metrics.observe("warehouse_request_rows", ROWS_BUCKETS, route, self.stats.rows)
+            metrics.inc("warehouse_request_sql_seconds_total", route, self.stats.sql_seconds)
+            metrics.inc("warehouse_request_json_seconds_total", route, self.stats.json_seconds)
+
+
+if METRICS_ENABLED:
+    app.json = TimedJSONProvider(app)
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+
+@app.before_request
+def label_route():
+    """记录匹配到的路由模板，作为指标的 route 标签（避免按具体 id 产生大量标签）"""
+    request.environ["warehouse.route"] = request.url_rule.rule if request.url_rule else "<unmatched>"
+
+
+class PooledConnection(sqlite3.Connection):
+    """线程内复用的数据库连接，close() 只回滚未提交的事务并归还连接"""
+    
+    def cursor(self, factory=None):
+        return super().cursor(factory or (TimedCursor if METRICS_ENABLED else sqlite3.Cursor))
+    
+    # Connection.execute 不经过 cursor()，这里显式转给带计时的游标
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        self.last_used = time.monotonic()
+    
+    def shutdown(self):
+        """真正关闭连接"""
+        super().close()
+
+
+# 每个线程持有一个连接；_all_connections 仅用于健康统计和退出时关闭
+_local = threading.local()
+_all_connections = weakref.WeakSet()
+
+
+def open_db_connection():
+    """打开新的数据库连接并设置连接参数"""
+    start = time.perf_counter()
+    conn = sqlite3.connect(DB_PATH, factory=PooledConnection, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma, value in DB_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if METRICS_ENABLED:
+        conn.set_trace_callback(trace_statement)
+        metrics.observe("warehouse_db_connection_open_seconds", LATENCY_BUCKETS, (), time.perf_counter() - start)
+    conn.last_used = time.monotonic()
+    _all_connections.add(conn)
     return conn
 
 
+def get_db_connection():
+    """获取当前线程的数据库连接（不存在或已失效时重新打开）"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and time.monotonic() - conn.last_used > DB_HEALTH_CHECK_INTERVAL:
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            _all_connections.discard(conn)
+            conn = None
+    if conn is None:
+        conn = open_db_connection()
+        _local.conn = conn
+    return conn
+
+
+def close_all_connections():
+    """关闭所有线程的数据库连接（进程退出时调用）"""
+    for conn in list(_all_connections):
+        try:
+            conn.shutdown()
+        except sqlite3.Error:
+            pass
+        _all_connections.discard(conn)
+    _local.__dict__.pop('conn', None)
+
+
+atexit.register(close_all_connections)
+
+
+@app.teardown_request
+def release_db_connection(exc):
+    """请求结束时回滚当前线程连接上未提交的事务"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+
+
 def init_db():
-    """初始化数据库表"""
+    """初始化数据库：执行未应用的迁移，然后创建全文检索索引"""
     conn = get_db_connection()
+    try:
+        run_migrations(conn)
+        
+        # 全文检索依赖当前 SQLite 是否支持 FTS5，告警参数来自环境变量，每次启动时设置，不作为迁移
+        conn.execute('BEGIN IMMEDIATE')
+        init_search_index(conn.cursor())
+        configure_alerts(conn.cursor())
+        conn.commit()
+        
+        # 上次退出时未完成的任务不会再有进程执行
+        expire_stale_jobs(conn)
+    finally:
+        conn.close()
+
+
+def run_migrations(conn):
+    """按顺序执行未应用的迁移，每个迁移一个事务，返回当前版本号"""
     cursor = conn.cursor()
-    
+    while True:
+        # 先拿写锁再读版本号，多个进程同时启动时每个迁移只会执行一次
+        conn.execute('BEGIN IMMEDIATE')
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return version
+        MIGRATIONS[version](cursor)
+        cursor.execute(f'PRAGMA user_version = {version + 1}')
+        conn.commit()
+
+
+def migrate_base_tables(cursor):
+    """v1：货物表和历史记录表"""
     # 创建货物表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS goods (
@@ -54,159 +650,860 @@ def init_db():
             timestamp TEXT NOT NULL
         )
     ''')
+
+
+def migrate_goods_generation(cursor):
+    """v2：元数据表，goods_generation 为货物表的修改代数，供多进程缓存判断是否失效"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('goods_generation', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS goods_generation_{event.lower()} AFTER {event} ON goods BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'goods_generation';
+            END
+        ''')
+
+
+def migrate_change_log(cursor):
+    """v3：变更序列表和触发器，每个 货物/历史记录 只保留最新一次变更（删除记为墓碑）"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'changes'")
+    exists = cursor.fetchone() is not None
+    
+    # seq 单调递增且不复用；INSERT OR REPLACE 使同一行的旧变更被新序号取代
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (entity, entity_id)
+        )
+    ''')
     
-    conn.commit()
-    conn.close()
+    for table in SYNC_TABLES:
+        for event, row, deleted in (('INSERT', 'new', 0), ('UPDATE', 'new', 0), ('DELETE', 'old', 1)):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.lower()} AFTER {event} ON {table} BEGIN
+                    INSERT OR REPLACE INTO changes (entity, entity_id, deleted) VALUES ('{table}', {row}.id, {deleted});
+                END
+            ''')
+        
+        # 已有数据库首次启用时，把现有数据记为变更，保证从 0 开始同步能拿到全部数据
+        if not exists:
+            cursor.execute(f"INSERT INTO changes (entity, entity_id) SELECT '{table}', id FROM {table} ORDER BY id")
 
 
-# 初始化数据库
-init_db()
+def migrate_query_indexes(cursor):
+    """v4：常用查询的索引"""
+    # 导入 upsert 按 名称+位置 匹配；NOCASE 索引用于名称/位置的前缀 LIKE
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_goods_name_location ON goods (name, location)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_goods_name_nocase ON goods (name COLLATE NOCASE)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_goods_location ON goods (location COLLATE NOCASE)')
+    # 部分索引只包含低库存货物，低库存查询的代价与结果数成正比
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_goods_low_stock ON goods (id) WHERE quantity <= min_quantity')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_goods_name ON history (goods_name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)')
 
 
-def load_goods():
-    """加载货物数据"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM goods ORDER BY id')
-    rows = cursor.fetchall()
-    conn.close()
+def migrate_history_goods_id(cursor):
+    """v5：历史记录关联货物 id（按货物名称回填已有记录），并按 货物+时间 建索引"""
+    cursor.execute('PRAGMA table_info(history)')
+    if "goods_id" not in [row["name"] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE history ADD COLUMN goods_id INTEGER REFERENCES goods (id)')
+    # 同名货物有多个时关联到最早创建的一个
+    cursor.execute('''
+        UPDATE history SET goods_id = (SELECT MIN(id) FROM goods WHERE goods.name = history.goods_name)
+        WHERE goods_id IS NULL
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_goods_time ON history (goods_id, timestamp)')
+
+
+def migrate_stats_tables(cursor):
+    """v6：库存汇总表（按位置）和出入库汇总表（按小时），由触发器在同一事务中增量维护"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_location (
+            location TEXT PRIMARY KEY,
+            goods_count INTEGER NOT NULL DEFAULT 0,
+            total_quantity INTEGER NOT NULL DEFAULT 0,
+            total_value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_movement_hourly (
+            hour TEXT NOT NULL,
+            operation_type TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            movements INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, operation_type)
+        )
+    ''')
     
-    goods_list = []
-    for row in rows:
-        goods = {
-            "id": row["id"],
-            "_id": str(row["id"]),
-            "name": row["name"],
-            "price": row["price"],
-            "location": row["location"],
-            "quantity": row["quantity"],
-            "stock": row["stock"],
-            "min_quantity": row["min_quantity"],
-            "description": row["description"],
-            "created_at": row["created_at"],
-            "updated_at": row["updated_at"]
-        }
-        goods_list.append(goods)
+    # 货物增删改时先减去旧值再加上新值
+    add_location = '''
+        INSERT INTO stats_location (location, goods_count, total_quantity, total_value)
+        VALUES (new.location, 1, new.quantity, new.price * new.quantity)
+        ON CONFLICT (location) DO UPDATE SET
+            goods_count = goods_count + 1,
+            total_quantity = total_quantity + new.quantity,
+            total_value = total_value + new.price * new.quantity;
+    '''
+    remove_location = '''
+        UPDATE stats_location SET
+            goods_count = goods_count - 1,
+            total_quantity = total_quantity - old.quantity,
+            total_value = total_value - old.price * old.quantity
+        WHERE location = old.location;
+    '''
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS stats_goods_insert AFTER INSERT ON goods BEGIN {add_location} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS stats_goods_delete AFTER DELETE ON goods BEGIN {remove_location} END")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stats_goods_update AFTER UPDATE OF quantity, price, location ON goods BEGIN
+            {remove_location}
+            {add_location}
+        END
+    ''')
     
-    return {"goods": goods_list}
+    # 出入库汇总只随新增历史记录累加；删除或归档历史记录不影响已统计的出入库量
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_history_insert AFTER INSERT ON history BEGIN
+            INSERT INTO stats_movement_hourly (hour, operation_type, quantity, movements)
+            VALUES (substr(new.timestamp, 1, 13), new.operation_type, abs(new.quantity), 1)
+            ON CONFLICT (hour, operation_type) DO UPDATE SET
+                quantity = quantity + abs(new.quantity),
+                movements = movements + 1;
+        END
+    ''')
+    
+    rebuild_location_stats(cursor)
+    cursor.execute('DELETE FROM stats_movement_hourly')
+    cursor.execute('''
+        INSERT INTO stats_movement_hourly (hour, operation_type, quantity, movements)
+        SELECT substr(timestamp, 1, 13), operation_type, SUM(abs(quantity)), COUNT(*)
+        FROM history GROUP BY 1, 2
+    ''')
 
 
-def save_goods(data):
-    """保存货物数据（已弃用，使用数据库操作）"""
-    pass
+def rebuild_location_stats(cursor):
+    """从货物表重新计算按位置的库存汇总（消除浮点累加误差）"""
+    cursor.execute('DELETE FROM stats_location')
+    cursor.execute('''
+        INSERT INTO stats_location (location, goods_count, total_quantity, total_value)
+        SELECT location, COUNT(*), SUM(quantity), SUM(price * quantity) FROM goods GROUP BY location
+    ''')
 
 
-def load_history():
-    """加载操作历史"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM history ORDER BY id DESC')
-    rows = cursor.fetchall()
-    conn.close()
+def migrate_jobs_table(cursor):
+    """v7：后台任务表（批量删除、归档等），记录进度和取消请求"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            total INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+
+def migrate_event_log(cursor):
+    """v8：实时事件表，由触发器在写入事务中追加，SSE 按 seq 顺序推送"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+    ''')
     
-    history_list = []
-    for row in rows:
-        record = {
-            "id": row["id"],
-            "_id": str(row["id"]),
-            "goods_name": row["goods_name"],
-            "operation_type": row["operation_type"],
-            "quantity": row["quantity"],
-            "notes": row["notes"],
-            "timestamp": row["timestamp"],
-            "time": row["timestamp"]
-        }
-        history_list.append(record)
+    goods_data = "json_object('id', {row}.id, 'name', {row}.name, 'location', {row}.location, " \
+                 "'price', {row}.price, 'quantity', {row}.quantity, 'min_quantity', {row}.min_quantity)"
+    for event, row, event_type in (('INSERT', 'new', 'goods.created'), ('UPDATE', 'new', 'goods.updated'),
+                                   ('DELETE', 'old', 'goods.deleted')):
+        data = goods_data.format(row=row) if row == 'new' else "json_object('id', old.id)"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS goods_events_{event.lower()} AFTER {event} ON goods BEGIN
+                INSERT INTO events (type, data) VALUES ('{event_type}', {data});
+            END
+        ''')
+    # 库存从高于最低库存变为不高于最低库存时发出低库存事件
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS goods_events_low_stock AFTER UPDATE OF quantity, min_quantity ON goods
+        WHEN new.quantity <= new.min_quantity AND old.quantity > old.min_quantity BEGIN
+            INSERT INTO events (type, data) VALUES ('stock.low', json_object(
+                'id', new.id, 'name', new.name, 'quantity', new.quantity, 'min_quantity', new.min_quantity));
+        END
+    ''')
+    # 出入库时库存已先行更新，quantity 为变动后的库存
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS history_events_insert AFTER INSERT ON history BEGIN
+            INSERT INTO events (type, data) VALUES ('stock.moved', json_object(
+                'history_id', new.id, 'goods_id', new.goods_id,
+                'op', CASE new.operation_type WHEN '入库' THEN 'in' ELSE 'out' END,
+                'quantity', abs(new.quantity),
+                'stock', (SELECT quantity FROM goods WHERE id = new.goods_id)));
+        END
+    ''')
+
+
+def migrate_alert_tables(cursor):
+    """v9：低库存告警表和通知发件箱，由触发器在库存变化的事务中维护（只在跨越最低库存时写入）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            goods_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            quantity INTEGER,
+            min_quantity INTEGER,
+            opened_at TEXT NOT NULL,
+            resolved_at TEXT
+        )
+    ''')
+    # 每个货物最多一条未解除的告警；部分索引同时是低库存接口的扫描顺序
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_open ON alerts (goods_id) WHERE status = 'open'")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_alerts_goods ON alerts (goods_id, resolved_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alert_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alert_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('alert_debounce_seconds', ?)",
+                   (ALERT_DEBOUNCE_SECONDS,))
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('alert_outbox_enabled', 0)")
+    
+    now = "datetime('now', 'localtime')"
+    # 最近刚解除的告警重新打开（抖动），否则新建告警；新建的告警才会进入发件箱
+    open_alert = f'''
+        UPDATE alerts SET status = 'open', resolved_at = NULL, quantity = new.quantity, min_quantity = new.min_quantity
+        WHERE id = (
+            SELECT id FROM alerts WHERE goods_id = new.id AND status = 'resolved' AND resolved_at >= datetime(
+                'now', 'localtime', '-' || (SELECT value FROM meta WHERE key = 'alert_debounce_seconds') || ' seconds')
+            ORDER BY resolved_at DESC LIMIT 1
+        ) AND NOT EXISTS (SELECT 1 FROM alerts WHERE goods_id = new.id AND status = 'open');
+        INSERT INTO alerts (goods_id, status, quantity, min_quantity, opened_at)
+        SELECT new.id, 'open', new.quantity, new.min_quantity, {now}
+        WHERE NOT EXISTS (SELECT 1 FROM alerts WHERE goods_id = new.id AND status = 'open');
+    '''
+    resolve_alert = f'''
+        UPDATE alerts SET status = 'resolved', resolved_at = {now}, quantity = {{row}}.quantity
+        WHERE goods_id = {{row}}.id AND status = 'open';
+    '''
+    is_low = "IFNULL({row}.quantity <= {row}.min_quantity, 0)"
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS alerts_goods_insert AFTER INSERT ON goods
+        WHEN {is_low.format(row='new')} BEGIN {open_alert} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS alerts_goods_low AFTER UPDATE OF quantity, min_quantity ON goods
+        WHEN {is_low.format(row='new')} AND NOT {is_low.format(row='old')} BEGIN {open_alert} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS alerts_goods_recovered AFTER UPDATE OF quantity, min_quantity ON goods
+        WHEN {is_low.format(row='old')} AND NOT {is_low.format(row='new')} BEGIN {resolve_alert.format(row='new')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS alerts_goods_delete AFTER DELETE ON goods
+        BEGIN {resolve_alert.format(row='old')} END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS alerts_outbox_insert AFTER INSERT ON alerts
+        WHEN (SELECT value FROM meta WHERE key = 'alert_outbox_enabled') = 1 BEGIN
+            INSERT INTO alert_outbox (alert_id, payload, next_attempt_at) VALUES (new.id, json_object(
+                'type', 'stock.low', 'alert_id', new.id, 'goods_id', new.goods_id,
+                'name', (SELECT name FROM goods WHERE id = new.goods_id),
+                'quantity', new.quantity, 'min_quantity', new.min_quantity, 'opened_at', new.opened_at
+            ), new.opened_at);
+        END
+    ''')
     
-    return {"history": history_list}
+    reconcile_alerts(cursor)
 
 
-def save_history(data):
-    """保存操作历史（已弃用，使用数据库操作）"""
-    pass
+def migrate_goods_sku(cursor):
+    """v10：货物条码/SKU（可为空，非空时唯一），扫码按 SKU 索引查询；货物事件带上 sku"""
+    cursor.execute('PRAGMA table_info(goods)')
+    if "sku" not in [row["name"] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE goods ADD COLUMN sku TEXT')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_goods_sku ON goods (sku)')
+    
+    goods_data = "json_object('id', new.id, 'name', new.name, 'sku', new.sku, 'location', new.location, " \
+                 "'price', new.price, 'quantity', new.quantity, 'min_quantity', new.min_quantity)"
+    for event, event_type in (('INSERT', 'goods.created'), ('UPDATE', 'goods.updated')):
+        cursor.execute(f'DROP TRIGGER IF EXISTS goods_events_{event.lower()}')
+        cursor.execute(f'''
+            CREATE TRIGGER goods_events_{event.lower()} AFTER {event} ON goods BEGIN
+                INSERT INTO events (type, data) VALUES ('{event_type}', {goods_data});
+            END
+        ''')
+
+
+def migrate_drop_unused_indexes(cursor):
+    """v11：删除没有查询使用的索引（历史记录按名称检索走全文检索或子串 LIKE，用不到名称索引）"""
+    cursor.execute('DROP INDEX IF EXISTS idx_history_goods_name')
+
+
+def migrate_history_op_index(cursor):
+    """v12：历史记录按 操作类型+时间 建索引，按操作类型筛选时按索引范围读取，不必扫描整个时间索引"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_op_time ON history (operation_type, timestamp)')
+
+
+def migrate_job_heartbeat(cursor):
+    """v13：后台任务心跳时间，执行任务的进程退出后任务可按租约过期结束"""
+    cursor.execute('PRAGMA table_info(jobs)')
+    if "heartbeat_at" not in [row["name"] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT')
+
+
+def reconcile_alerts(cursor):
+    """按货物表当前库存校正告警：为低库存货物补开告警，解除已不再低库存的告警"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute('''
+        UPDATE alerts SET status = 'resolved', resolved_at = ?
+        WHERE status = 'open' AND goods_id NOT IN (SELECT id FROM goods WHERE quantity <= min_quantity)
+    ''', (now,))
+    cursor.execute('''
+        INSERT INTO alerts (goods_id, status, quantity, min_quantity, opened_at)
+        SELECT id, 'open', quantity, min_quantity, ? FROM goods
+        WHERE quantity <= min_quantity AND id NOT IN (SELECT goods_id FROM alerts WHERE status = 'open')
+    ''', (now,))
+
+
+def configure_alerts(cursor):
+    """把告警参数写入元数据表，供触发器读取"""
+    cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('alert_debounce_seconds', ?)",
+                   (ALERT_DEBOUNCE_SECONDS,))
+    cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('alert_outbox_enabled', ?)",
+                   (1 if ALERT_WEBHOOK_URL else 0,))
+
+
+# 数据库迁移，版本号为下标 + 1，记录在 PRAGMA user_version 中；已发布的迁移只能追加，不能修改
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_goods_generation,
+    migrate_change_log,
+    migrate_query_indexes,
+    migrate_history_goods_id,
+    migrate_stats_tables,
+    migrate_jobs_table,
+    migrate_event_log,
+    migrate_alert_tables,
+    migrate_goods_sku,
+    migrate_drop_unused_indexes,
+    migrate_history_op_index,
+    migrate_job_heartbeat,
+]
+
+# 路由使用的查询及其参数，check-query-plans 用 EXPLAIN QUERY PLAN 确认都走索引
+QUERY_PLAN_CHECKS = [
+    ("货物分页", 'SELECT * FROM goods WHERE id > ? ORDER BY id LIMIT ?', (0, 50)),
+    ("按位置前缀筛选货物", "SELECT * FROM goods WHERE +id > ? AND location LIKE ? ESCAPE '\\' ORDER BY id LIMIT ?",
+     (0, 'A%', 50)),
+    ("低库存货物分页", 'SELECT * FROM goods WHERE id > ? AND quantity <= min_quantity ORDER BY id LIMIT ?', (0, 50)),
+    ("按名称前缀搜索货物", "SELECT * FROM goods t WHERE name LIKE ? ESCAPE '\\' ORDER BY id", ('A%',)),
+    ("低库存货物", '''SELECT goods.* FROM alerts JOIN goods ON goods.id = alerts.goods_id
+                   WHERE alerts.status = 'open' ORDER BY alerts.goods_id''', ()),
+    ("按 id 获取货物", 'SELECT * FROM goods WHERE id IN (?, ?)', (1, 2)),
+    ("扫码按 SKU 获取货物", 'SELECT * FROM goods WHERE sku IN (?, ?)', ('A', 'B')),
+    ("导入时按名称+位置匹配", 'SELECT id, quantity FROM goods WHERE name = ? AND location = ?', ('A', 'A')),
+    ("货物历史分页", '''SELECT * FROM history WHERE goods_id = ? AND (timestamp, id) < (?, ?)
+                     ORDER BY timestamp DESC, id DESC LIMIT ?''', (1, '2024-01-01', 100, 50)),
+    ("历史记录时间范围分页", '''SELECT * FROM history WHERE timestamp >= ? AND timestamp < ?
+                          ORDER BY timestamp DESC, id DESC LIMIT ?''', ('2024-01-01', '2024-02-01', 50)),
+    ("按操作类型筛选历史", '''SELECT * FROM history WHERE operation_type = ?
+                        ORDER BY timestamp DESC, id DESC LIMIT ?''', ('入库', 50)),
+    ("按操作类型和时间范围筛选历史", '''SELECT * FROM history WHERE timestamp >= ? AND operation_type = ?
+                              ORDER BY timestamp DESC, id DESC LIMIT ?''', ('2024-01-01', '入库', 50)),
+    ("按时间范围分批删除历史", 'DELETE FROM history WHERE id IN (SELECT id FROM history WHERE timestamp < ? LIMIT ?)',
+     ('2024-01-01', 1000)),
+    ("增量同步", 'SELECT seq, entity, entity_id, deleted FROM changes WHERE seq > ? ORDER BY seq LIMIT ?', (0, 1000)),
+]
+
+# 只有游标条件的查询：按主键范围读到的每一行都会返回，代价由 LIMIT 限定，不算全表扫描
+QUERY_PLAN_CURSOR_ONLY = {"货物分页", "增量同步"}
+
+
+def check_query_plans():
+    """对 QUERY_PLAN_CHECKS 执行 EXPLAIN QUERY PLAN，返回 [(说明, 执行计划, 是否走索引)]"""
+    checks = list(QUERY_PLAN_CHECKS)
+    if FTS_ENABLED:
+        for table, (fts_table, _) in SEARCH_INDEXES.items():
+            checks.append((
+                f"全文检索 {table}",
+                f"SELECT t.* FROM {fts_table} f JOIN {table} t ON t.id = f.rowid WHERE {fts_table} MATCH ?",
+                ('"abc"',)
+            ))
+    
+    conn = get_db_connection()
+    # 部分索引只包含符合条件的行，完整扫描部分索引的代价仍与结果数成正比
+    partial_indexes = {row["name"] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'"
+    )}
+    results = []
+    for label, sql, params in checks:
+        plan = [row["detail"] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        # 除全文检索和部分索引外，SCAN 都是逐行读取整张表或整个索引（SCAN ... USING INDEX 只是按索引顺序读完）；
+        # 只有单侧 rowid 范围的 SEARCH 实际是按主键遍历、逐行过滤其余条件
+        full_scan = any(
+            d.startswith('SCAN ') and 'VIRTUAL TABLE' not in d
+            and not (' INDEX ' in d and d.split(' INDEX ')[1].split()[0] in partial_indexes)
+            for d in plan
+        )
+        if label not in QUERY_PLAN_CURSOR_ONLY:
+            full_scan = full_scan or any(f'(rowid{op}?)' in d for d in plan for op in ('>', '>=', '<', '<='))
+        results.append((label, plan, not full_scan))
+    conn.close()
+    return results
+
+
+def init_search_index(cursor):
+    """创建 FTS5 全文检索表和同步触发器，新建的检索表会从原表重建"""
+    global FTS_ENABLED
+    
+    for table, (fts_table, column) in SEARCH_INDEXES.items():
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,))
+        exists = cursor.fetchone() is not None
+        
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                    {column}, content='{table}', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            # SQLite 未编译 FTS5 或不支持 trigram 分词，搜索退回 LIKE 扫描
+            FTS_ENABLED = False
+            return
+        
+        # 通过触发器保持检索表与原表同步
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END
+        ''')
+        
+        if not exists:
+            cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+    
+    FTS_ENABLED = True
 
 
-def add_history_record(goods_name, operation_type, quantity, notes=""):
-    """添加操作历史记录"""
+def rebuild_search_index():
+    """从原表重建全部全文检索索引"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute(
-        'INSERT INTO history (goods_name, operation_type, quantity, notes, timestamp) VALUES (?, ?, ?, ?, ?)',
-        (goods_name, operation_type, quantity, notes, timestamp)
-    )
-    
-    record_id = cursor.lastrowid
+    for fts_table, _ in SEARCH_INDEXES.values():
+        cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
     conn.commit()
     conn.close()
-    
-    return {
-        "id": record_id,
-        "_id": str(record_id),
-        "goods_name": goods_name,
-        "operation_type": operation_type,
-        "quantity": quantity,
-        "notes": notes,
-        "timestamp": timestamp,
-        "time": timestamp
-    }
 
 
-# 主页
-@app.route('/')
-def index():
-    return render_template('index.html')
+# 数据库是否已在本进程（或 fork 出本进程的主进程）中初始化，以及已启动后台线程的进程号
+_app_lock = threading.Lock()
+_db_ready = False
+_threads_pid = None
 
 
-# ============ 货物管理API ============
+def prepare_database():
+    """初始化数据库（每个进程只执行一次），并关闭初始化用的连接，之后 fork 出的子进程不会继承打开的连接"""
+    global _db_ready
+    with _app_lock:
+        if not _db_ready:
+            init_db()
+            close_all_connections()
+            _db_ready = True
 
-# 获取所有货物
-@app.route('/api/goods', methods=['GET'])
-def get_goods():
-    data = load_goods()
-    return jsonify(data)
 
+def create_app():
+    """应用工厂：确保数据库已初始化，并在当前进程中启动后台线程，返回 app"""
+    global _threads_pid
+    prepare_database()
+    with _app_lock:
+        # 线程不会随 fork 复制，每个工作进程各自启动一次
+        if _threads_pid != os.getpid():
+            start_alert_dispatcher()
+            start_snapshot_scheduler()
+            start_event_pruner()
+            _threads_pid = os.getpid()
+    return app
 
-# 根据 _id 获取货物（兼容小程序）
-@app.route('/api/goods/by/_id/<string:goods_id>', methods=['GET'])
-def get_goods_by_uuid(goods_id):
-    data = load_goods()
-    for goods in data["goods"]:
-        if str(goods.get("id")) == goods_id or goods.get("_id") == goods_id:
-            return jsonify(goods)
-    return jsonify({"error": "货物不存在"}), 404
 
+def db_command(*args, **kwargs):
+    """注册需要数据库的命令行命令（flask --app app ...），执行前先初始化数据库"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*f_args, **f_kwargs):
+            prepare_database()
+            return f(*f_args, **f_kwargs)
+        return app.cli.command(*args, **kwargs)(wrapper)
+    return decorator
 
-# 搜索货物
-@app.route('/api/goods/search', methods=['GET'])
-def search_goods():
-    query = request.args.get('q', '').strip()
-    data = load_goods()
-    
-    if not query:
-        return jsonify(data)
-    
-    # 模糊搜索
-    results = [g for g in data["goods"] if query.lower() in g["name"].lower()]
-    return jsonify({"goods": results})
 
+@db_command('import-goods')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help="默认按文件扩展名判断")
+@click.option('--upsert', is_flag=True, help="按 名称+位置 更新已有货物")
+def import_goods_command(path, fmt, upsert):
+    """从 CSV/NDJSON 文件导入货物"""
+    fmt = data_format(fmt, filename=path)
+    with open(path, 'rb') as f:
+        result = import_goods(iter_import_records(f, fmt), upsert=upsert)
+    print(f"新增 {result['inserted']} 条，更新 {result['updated']} 条，失败 {result['failed']} 条")
+    for error in result["errors"]:
+        print(f"  第 {error['line']} 行: {error['error']}")
 
-# 根据 _id 修改货物（兼容小程序）
-@app.route('/api/goods/by/_id/<string:goods_id>', methods=['PUT'])
-def update_goods_by_uuid(goods_id):
-    goods_data = request.get_json()
+
+@db_command('export-goods')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help="默认按文件扩展名判断")
+def export_goods_command(path, fmt):
+    """导出货物到 CSV/NDJSON 文件"""
+    fmt = data_format(fmt, filename=path)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in iter_goods_export(fmt):
+            f.write(chunk)
+    print(f"已导出到 {path}")
+
+
+@db_command('migrate')
+def migrate_command():
+    """执行数据库迁移并显示当前版本"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 先查询货物
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
-        return jsonify({"error": "货物不存在"}), 404
-    
+    version = run_migrations(conn)
+    conn.close()
+    print(f"数据库版本: {version}")
+
+
+@db_command('check-query-plans')
+def check_query_plans_command():
+    """检查各路由查询的执行计划，存在全表扫描时返回非零退出码"""
+    failed = 0
+    for label, plan, ok in check_query_plans():
+        print(f"[{'OK' if ok else 'SCAN'}] {label}")
+        for detail in plan:
+            print(f"       {detail}")
+        failed += not ok
+    if failed:
+        raise SystemExit(1)
+
+
+@db_command('archive-history')
+@click.option('--days', type=int, default=None, help="归档早于该天数的历史记录，默认 HISTORY_RETENTION_DAYS")
+@click.option('--vacuum', is_flag=True, help="把已有数据库切换为增量 VACUUM 模式（执行一次完整 VACUUM）")
+def archive_history_command(days, vacuum):
+    """把过期的历史记录移到归档库"""
+    days = HISTORY_RETENTION_DAYS if days is None else days
+    archived = archive_history(days, vacuum=vacuum)
+    print(f"已归档 {archived} 条早于 {days} 天的历史记录到 {ARCHIVE_DB_PATH}")
+
+
+@db_command('rebuild-stats')
+def rebuild_stats_command():
+    """从货物表重新计算库存汇总"""
+    conn = get_db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    rebuild_location_stats(conn.cursor())
+    conn.commit()
+    conn.close()
+    print("库存汇总已重建")
+
+
+@db_command('rebuild-alerts')
+def rebuild_alerts_command():
+    """按当前库存校正低库存告警"""
+    conn = get_db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    reconcile_alerts(conn.cursor())
+    conn.commit()
+    conn.close()
+    print("已校正低库存告警")
+
+
+@db_command('rebuild-search')
+def rebuild_search_command():
+    """重建全文检索索引（用于已有数据库或索引损坏时）"""
+    if not FTS_ENABLED:
+        print("当前 SQLite 不支持 FTS5 trigram 分词，搜索使用 LIKE 扫描")
+        return
+    rebuild_search_index()
+    print("全文检索索引已重建")
+
+
+@db_command('backup')
+@click.argument('path', required=False)
+def backup_command(path):
+    """在线备份数据库到 PATH（无需停止服务）；不指定 PATH 时刷新报表快照"""
+    path = path or SNAPSHOT_PATH
+    snapshot = backup_database(path)
+    print(f"已备份到 {path}：{snapshot['pages']} 页，数据截至 {snapshot['taken_at']}，用时 {snapshot['seconds']:.1f}s")
+
+
+def load_goods():
+    """加载货物数据"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM goods ORDER BY id')
+    rows = cursor.fetchall()
+    conn.close()
+    
+    goods_list = [goods_to_dict(row) for row in rows]
+    return {"goods": goods_list}
+
+
+def goods_to_dict(row):
+    """将货物行转换为接口返回的字典"""
+    return {
+        "id": row["id"],
+        "_id": str(row["id"]),
+        "name": row["name"],
+        "sku": row["sku"],
+        "price": row["price"],
+        "location": row["location"],
+        "quantity": row["quantity"],
+        "stock": row["stock"],
+        "min_quantity": row["min_quantity"],
+        "description": row["description"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"]
+    }
+
+
+def query_goods_page(args):
+    """按游标分页查询货物，支持位置前缀、价格区间、低库存筛选和字段投影"""
+    try:
+        after_id = int(args.get('after_id', 0) or 0)
+        limit = int(args.get('limit', GOODS_PAGE_SIZE) or GOODS_PAGE_SIZE)
+        min_price = float(args['min_price']) if args.get('min_price') else None
+        max_price = float(args['max_price']) if args.get('max_price') else None
+    except ValueError:
+        raise ValueError("分页或价格参数格式错误")
+    if limit <= 0:
+        raise ValueError("limit 必须大于0")
+    limit = min(limit, GOODS_PAGE_MAX)
+    
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()] or GOODS_FIELDS
+    unknown = [f for f in fields if f not in GOODS_FIELDS]
+    if unknown:
+        raise ValueError(f"未知字段: {', '.join(unknown)}")
+    
+    # 构建筛选条件，id 为游标，结果始终按主键排序
+    conditions = ["id > ?"]
+    params = [after_id]
+    location = args.get('location', '').strip()
+    if location:
+        # 按主键遍历会逐行过滤位置，前缀少见时接近全表扫描；+id 让查询改走位置索引，
+        # 每页代价与该前缀下的货物数成正比
+        conditions[0] = "+id > ?"
+        escaped = location.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("location LIKE ? ESCAPE '\\'")
+        params.append(escaped + '%')
+    if min_price is not None:
+        conditions.append("price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append("price <= ?")
+        params.append(max_price)
+    if args.get('low_stock', '').lower() in ('1', 'true', 'yes'):
+        conditions.append("quantity <= min_quantity")
+    
+    # 只查询需要的列，_id 由 id 生成
+    columns = ["id"] + [f for f in fields if f not in ("id", "_id")]
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {', '.join(columns)} FROM goods WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+        params + [limit + 1]
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    
+    # 多取一条用于判断是否还有下一页
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    goods_list = []
+    for row in rows:
+        goods = {}
+        for field in fields:
+            goods[field] = str(row["id"]) if field == "_id" else row[field]
+        goods_list.append(goods)
+    
+    return {
+        "goods": goods_list,
+        "next_cursor": str(rows[-1]["id"]) if has_more else None
+    }
+
+
+def search_rows(table, query, args):
+    """全文检索搜索，返回 (行列表, 下一页 offset)；不带 limit 时返回全部匹配（兼容旧接口）"""
+    fts_table, column = SEARCH_INDEXES[table]
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+        offset = int(args.get('offset', 0) or 0)
+    except ValueError:
+        raise ValueError("分页参数格式错误")
+    if (limit is not None and limit <= 0) or offset < 0:
+        raise ValueError("分页参数必须大于0")
+    prefix = args.get('prefix', '').lower() in ('1', 'true', 'yes')
+    sort = args.get('sort', 'id')
+    if sort not in ('id', 'rank'):
+        raise ValueError("sort 只能是 id 或 rank")
+    
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    like = escaped + '%' if prefix else '%' + escaped + '%'
+    
+    if FTS_ENABLED and len(query) >= SEARCH_MIN_TRIGRAM:
+        # trigram 短语匹配即子串匹配，大小写不敏感
+        sql = f'''SELECT t.* FROM {fts_table} f JOIN {table} t ON t.id = f.rowid
+                  WHERE {fts_table} MATCH ?'''
+        params = ['"' + query.replace('"', '""') + '"']
+        if prefix:
+            sql += f" AND t.{column} LIKE ? ESCAPE '\\'"
+            params.append(like)
+        sql += " ORDER BY f.rank" if sort == 'rank' else f" ORDER BY t.id{' DESC' if table == 'history' else ''}"
+    else:
+        sql = f"SELECT * FROM {table} t WHERE {column} LIKE ? ESCAPE '\\'"
+        params = [like]
+        if sort == 'rank':
+            # 无检索索引时以名称长度近似相关度：越短越接近关键词
+            sql += f" ORDER BY length({column}), id"
+        else:
+            sql += f" ORDER BY id{' DESC' if table == 'history' else ''}"
+    
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit + 1, offset]
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    conn.close()
+    
+    next_offset = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+    return rows, next_offset
+
+
+def save_goods(data):
+    """保存货物数据（已弃用，使用数据库操作）"""
+    pass
+
+
+def load_history():
+    """加载操作历史"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM history ORDER BY id DESC')
+    rows = cursor.fetchall()
+    conn.close()
+    
+    history_list = [history_to_dict(row) for row in rows]
+    return {"history": history_list}
+
+
+def history_to_dict(row):
+    """将历史记录行转换为接口返回的字典"""
+    return {
+        "id": row["id"],
+        "_id": str(row["id"]),
+        "goods_id": row["goods_id"],
+        "goods_name": row["goods_name"],
+        "operation_type": row["operation_type"],
+        "quantity": row["quantity"],
+        "notes": row["notes"],
+        "timestamp": row["timestamp"],
+        "time": row["timestamp"]
+    }
+
+
+def resolve_id(value):
+    """解析路径或参数中的 id（整数或数字字符串，兼容小程序 _id），无效时返回 None"""
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    # isdigit 也接受 '²' 等 Unicode 数字，int() 会报错，只认 ASCII 数字
+    return int(value) if value.isascii() and value.isdigit() else None
+
+
+def fetch_goods_by_ids(ids):
+    """按主键批量查询货物（单条 IN 查询），返回 {id: 行}"""
+    if not ids:
+        return {}
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT * FROM goods WHERE id IN ({', '.join('?' * len(ids))})", ids)
+    rows = cursor.fetchall()
+    conn.close()
+    return {row["id"]: row for row in rows}
+
+
+def normalize_sku(value):
+    """规范化请求中的 SKU：去掉首尾空白，空值为 None（数字条码按字符串保存），格式错误时抛出 ValueError"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError("sku 格式错误")
+    value = str(value).strip()
+    if len(value) > SKU_MAX_LENGTH:
+        raise ValueError(f"sku 不能超过 {SKU_MAX_LENGTH} 个字符")
+    return value or None
+
+
+def fetch_goods_by_skus(codes):
+    """按 SKU 批量查询货物，返回 {SKU: 行}；先按内存映射用主键取行并核对 SKU，缺失或过期的再查 SKU 索引"""
+    mapped = {code: sku_index.get(code) for code in codes}
+    rows = fetch_goods_by_ids([i for i in mapped.values() if i is not None])
+    found = {}
+    for code, goods_id in mapped.items():
+        row = rows.get(goods_id)
+        if row is not None and row["sku"] == code:
+            found[code] = row
+    
+    missing = [code for code in codes if code not in found]
+    if missing:
+        conn = get_db_connection()
+        # 分批 IN 查询，避免超过 SQLite 参数个数上限
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            for row in conn.execute(f"SELECT * FROM goods WHERE sku IN ({', '.join('?' * len(chunk))})", chunk):
+                found[row["sku"]] = row
+                sku_index.put(row["sku"], row["id"])
+        conn.close()
+        for code in missing:
+            if code not in found:
+                sku_index.discard(code)
+    return found
+
+
+def update_goods_record(goods_id, goods_data):
+    """按主键修改货物并返回接口响应"""
     # 构建更新语句
     update_fields = []
     params = []
@@ -236,70 +1533,1514 @@ def update_goods_by_uuid(goods_id):
     if "description" in goods_data:
         update_fields.append("description = ?")
         params.append(goods_data["description"])
+    if "sku" in goods_data:
+        try:
+            sku = normalize_sku(goods_data["sku"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        update_fields.append("sku = ?")
+        params.append(sku)
     
     update_fields.append("updated_at = ?")
     params.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     
     params.append(goods_id)
     
-    cursor.execute(f"UPDATE goods SET {', '.join(update_fields)} WHERE id = ?", params)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE goods SET {', '.join(update_fields)} WHERE id = ? RETURNING {GOODS_RETURNING}", params)
+        updated_goods = cursor.fetchone()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": "SKU 已被其他货物使用"}), 409
+    conn.commit()
+    conn.close()
+    
+    if not updated_goods:
+        return jsonify({"error": "货物不存在"}), 404
+    if updated_goods["sku"]:
+        sku_index.put(updated_goods["sku"], updated_goods["id"])
+    return jsonify({"success": True, "goods": goods_to_dict(updated_goods)})
+
+
+def delete_goods_record(goods_id):
+    """按主键删除货物并返回接口响应"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM goods WHERE id = ? RETURNING {GOODS_RETURNING}", (goods_id,))
+    goods = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    
+    if not goods:
+        return jsonify({"error": "货物不存在"}), 404
+    if goods["sku"]:
+        sku_index.discard(goods["sku"])
+    return jsonify({"success": True, "goods": goods_to_dict(goods)})
+
+
+def delete_history_by_id(record_id):
+    """按主键删除历史记录并返回接口响应"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM history WHERE id = ? RETURNING *', (record_id,))
+    record = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    
+    if not record:
+        return jsonify({"error": "记录不存在"}), 404
+    return jsonify({"success": True, "record": history_to_dict(record)})
+
+
+def parse_time_bound(value, upper=False):
+    """解析 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS；只有日期的上界包含当天，返回 (比较符, 时间字符串)"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if not upper:
+            return ">=", parsed.strftime("%Y-%m-%d %H:%M:%S")
+        if fmt == "%Y-%m-%d":
+            return "<", (parsed + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        return "<=", parsed.strftime("%Y-%m-%d %H:%M:%S")
+    raise ValueError("时间格式应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS")
+
+
+def history_filters(args, goods_id=None):
+    """根据 goods_id/from/to/op 参数构建历史记录筛选条件，返回 (条件列表, 参数列表)"""
+    conditions = []
+    params = []
+    if goods_id is not None:
+        conditions.append("goods_id = ?")
+        params.append(goods_id)
+    if args.get('from'):
+        op, value = parse_time_bound(args['from'])
+        conditions.append(f"timestamp {op} ?")
+        params.append(value)
+    if args.get('to'):
+        op, value = parse_time_bound(args['to'], upper=True)
+        conditions.append(f"timestamp {op} ?")
+        params.append(value)
+    if args.get('op'):
+        operation_type = STOCK_BATCH_OPS.get(args['op'], args['op'])
+        if operation_type not in ("入库", "出库"):
+            raise ValueError("op 只能是 in 或 out")
+        conditions.append("operation_type = ?")
+        params.append(operation_type)
+    return conditions, params
+
+
+def query_history_page(args, goods_id=None):
+    """按时间倒序分页查询历史记录，支持货物、时间范围和操作类型筛选，cursor 为上一页最后一条的 id"""
+    # archived=1 时查询归档库中的历史记录
+    table = "history"
+    if args.get('archived', '').lower() in ('1', 'true', 'yes'):
+        table = "archive.history"
+    
+    try:
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE) or HISTORY_PAGE_SIZE)
+        cursor_id = int(args['cursor']) if args.get('cursor') else None
+        if goods_id is None and args.get('goods_id'):
+            goods_id = int(args['goods_id'])
+    except ValueError:
+        raise ValueError("分页参数格式错误")
+    if limit <= 0:
+        raise ValueError("limit 必须大于0")
+    limit = min(limit, HISTORY_PAGE_MAX)
+    
+    conditions, params = history_filters(args, goods_id)
+    
+    # 归档库附加在临时连接上，用完即关闭；附加到线程复用的连接上，之后该线程的写事务都会连带锁住归档库
+    archived = table == "archive.history"
+    conn = open_db_connection() if archived else get_db_connection()
+    try:
+        if archived:
+            attach_archive(conn)
+        cursor = conn.cursor()
+        if cursor_id is not None:
+            # 游标只传 id，时间从主键查出，(timestamp, id) 组合保证翻页不重不漏
+            cursor.execute(f'SELECT timestamp FROM {table} WHERE id = ?', (cursor_id,))
+            last = cursor.fetchone()
+            if last is None:
+                raise ValueError("cursor 无效")
+            conditions.append("(timestamp, id) < (?, ?)")
+            params += [last["timestamp"], cursor_id]
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        cursor.execute(
+            f"SELECT * FROM {table} {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+            params + [limit + 1]
+        )
+        rows = cursor.fetchall()
+    finally:
+        if archived:
+            conn.shutdown()
+        else:
+            conn.close()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "history": [history_to_dict(row) for row in rows],
+        "next_cursor": str(rows[-1]["id"]) if has_more else None
+    }
+
+
+def attach_archive(conn):
+    """把归档库以 archive 名称附加到连接上（已附加则跳过），并确保归档表存在"""
+    if any(row["name"] == "archive" for row in conn.execute('PRAGMA database_list')):
+        return
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.history (
+            id INTEGER PRIMARY KEY,
+            goods_id INTEGER,
+            goods_name TEXT NOT NULL,
+            operation_type TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            notes TEXT DEFAULT '',
+            timestamp TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_history_timestamp ON history (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_history_goods_time ON history (goods_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_history_op_time ON history (operation_type, timestamp)')
+
+
+def archive_history(days, vacuum=False, job_id=None):
+    """把早于 days 天的历史记录分批移到归档库，每批一个短事务，返回归档条数"""
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    
+    def archive_batch(conn, batch_size):
+        # 本批要归档的 id：归档库中没有，或已有内容相同的副本（例如主库从备份恢复）；
+        # 归档库中同 id 但内容不同的记录（主库重建后 id 被复用）不归档，留在主库
+        ids = [row["id"] for row in conn.execute('''
+            SELECT m.id FROM main.history m LEFT JOIN archive.history a ON a.id = m.id
+            WHERE m.timestamp < ? AND (
+                a.id IS NULL
+                OR (a.goods_id, a.goods_name, a.operation_type, a.quantity, a.notes, a.timestamp)
+                   IS (m.goods_id, m.goods_name, m.operation_type, m.quantity, m.notes, m.timestamp)
+            )
+            ORDER BY m.timestamp, m.id LIMIT ?
+        ''', (cutoff, batch_size))]
+        if not ids:
+            return 0
+        placeholders = ', '.join('?' * len(ids))
+        # 先复制再删除，只删除归档库中确实存在的记录
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.history
+                (id, goods_id, goods_name, operation_type, quantity, notes, timestamp)
+            SELECT id, goods_id, goods_name, operation_type, quantity, notes, timestamp
+            FROM main.history WHERE id IN ({placeholders})
+        ''', ids)
+        return conn.execute(f'''
+            DELETE FROM main.history WHERE id IN (
+                SELECT id FROM archive.history WHERE id IN ({placeholders})
+            )
+        ''', ids).rowcount
+    
+    conn = open_db_connection()
+    try:
+        attach_archive(conn)
+        archived = run_batches(conn, archive_batch, job_id)
+        
+        if vacuum:
+            # 把已有数据库切换为增量 VACUUM 模式（需要完整 VACUUM 一次，期间会锁库）
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        elif conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            conn.execute(f'PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})')
+    finally:
+        conn.shutdown()
+    return archived
+
+
+def delete_history_batches(conditions, params, job_id=None):
+    """按筛选条件分批删除历史记录，每批一个短事务，返回删除条数"""
+    where = ' AND '.join(conditions) or '1'
+    
+    def delete_batch(conn, batch_size):
+        return conn.execute(
+            f"DELETE FROM history WHERE id IN (SELECT id FROM history WHERE {where} LIMIT ?)",
+            params + [batch_size]
+        ).rowcount
+    
+    conn = open_db_connection()
+    try:
+        return run_batches(conn, delete_batch, job_id)
+    finally:
+        conn.shutdown()
+
+
+def run_batches(conn, step, job_id=None):
+    """反复执行 step(conn, 批大小)，每批一个 BEGIN IMMEDIATE 事务，直到某批不足批大小
+    
+    传入 job_id 时每批更新任务进度，并在批次之间检查是否已请求取消。
+    """
+    processed = 0
+    while True:
+        if job_id is not None:
+            status = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()["status"]
+            if status == "cancelling":
+                update_job(conn, job_id, status="cancelled")
+                return processed
+        
+        conn.execute('BEGIN IMMEDIATE')
+        count = step(conn, BULK_BATCH_SIZE)
+        if job_id is not None:
+            conn.execute(
+                'UPDATE jobs SET processed = processed + ?, updated_at = ? WHERE id = ?',
+                (count, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id)
+            )
+        conn.commit()
+        processed += count
+        if count < BULK_BATCH_SIZE:
+            break
+        # 批次之间让出写锁，出入库请求不会被长时间阻塞
+        time.sleep(BULK_BATCH_PAUSE)
+    
+    if job_id is not None:
+        update_job(conn, job_id, status="done")
+    return processed
+
+
+# ============ 后台任务 ============
+
+def create_job(kind, params, total):
+    """登记后台任务，返回任务 id（任务状态存在数据库中，所有进程可见）"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''INSERT INTO jobs (kind, status, params, total, processed, created_at, updated_at, heartbeat_at)
+           VALUES (?, 'running', ?, ?, 0, ?, ?, ?)''',
+        (kind, json.dumps(params, ensure_ascii=False), total, timestamp, timestamp, timestamp)
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def update_job(conn, job_id, **fields):
+    """更新任务字段"""
+    fields["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute(
+        f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+        list(fields.values()) + [job_id]
+    )
+    conn.commit()
+
+
+def start_job(kind, params, total, target, *args):
+    """登记任务并在后台线程中执行 target(*args, job_id=...)，返回任务 id"""
+    job_id = create_job(kind, params, total)
+    
+    def run():
+        stop = threading.Event()
+        threading.Thread(target=run_job_heartbeat, args=(job_id, stop), name=f"job-{job_id}-heartbeat",
+                         daemon=True).start()
+        try:
+            target(*args, job_id=job_id)
+        except Exception as e:
+            conn = open_db_connection()
+            try:
+                update_job(conn, job_id, status="failed", error=str(e))
+            finally:
+                conn.shutdown()
+        finally:
+            stop.set()
+    
+    threading.Thread(target=run, name=f"job-{job_id}", daemon=True).start()
+    return job_id
+
+
+def run_job_heartbeat(job_id, stop):
+    """任务执行期间定期更新心跳时间，直到 stop 被设置"""
+    conn = open_db_connection()
+    try:
+        while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                conn.execute('UPDATE jobs SET heartbeat_at = ? WHERE id = ?',
+                             (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+    finally:
+        conn.shutdown()
+
+
+def expire_stale_jobs(conn):
+    """结束超过租约时间没有心跳的运行中任务（执行进程已退出）：运行中的记为失败，取消中的记为已取消"""
+    lease = (datetime.now() - timedelta(seconds=JOB_LEASE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    stale = "status IN ('running', 'cancelling') AND COALESCE(heartbeat_at, updated_at) < ?"
+    # 先只读检查，没有过期任务时不占用写锁
+    if conn.execute(f'SELECT 1 FROM jobs WHERE {stale} LIMIT 1', (lease,)).fetchone() is None:
+        return
+    conn.execute(f'''
+        UPDATE jobs SET status = CASE status WHEN 'cancelling' THEN 'cancelled' ELSE 'failed' END,
+                        error = CASE status WHEN 'cancelling' THEN error ELSE '任务中断：执行任务的进程已退出' END,
+                        updated_at = ?
+        WHERE {stale}
+    ''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), lease))
+    conn.commit()
+
+
+def job_to_dict(row):
+    """将任务行转换为接口返回的字典"""
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "params": json.loads(row["params"]),
+        "total": row["total"],
+        "processed": row["processed"],
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"]
+    }
+
+
+def get_job(job_id):
+    """按 id 查询任务，不存在时返回 None"""
+    conn = get_db_connection()
+    expire_stale_jobs(conn)
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    return job_to_dict(row) if row else None
+
+
+def delete_history_response(conditions, params, filters):
+    """删除符合条件的历史记录：不超过一批时直接删除，否则转为后台任务并返回 202 和任务信息"""
+    where = ' AND '.join(conditions) or '1'
+    conn = get_db_connection()
+    total = conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+    conn.close()
+    
+    if total <= BULK_BATCH_SIZE:
+        deleted = delete_history_batches(conditions, params)
+        return jsonify({"success": True, "deleted": deleted})
+    
+    job_id = start_job("delete_history", filters, total, delete_history_batches, conditions, params)
+    return jsonify({"success": True, "job": get_job(job_id)}), 202
+
+
+def save_history(data):
+    """保存操作历史（已弃用，使用数据库操作）"""
+    pass
+
+
+def add_history_record(goods_name, operation_type, quantity, notes="", cursor=None, goods_id=None):
+    """添加操作历史记录；传入 cursor 时在调用方的事务中写入，由调用方提交"""
+    own_connection = cursor is None
+    if own_connection:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+    
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(
+        'INSERT INTO history (goods_id, goods_name, operation_type, quantity, notes, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+        (goods_id, goods_name, operation_type, quantity, notes, timestamp)
+    )
+    
+    record_id = cursor.lastrowid
+    if own_connection:
+        conn.commit()
+        conn.close()
+    
+    return history_to_dict({
+        "id": record_id,
+        "goods_id": goods_id,
+        "goods_name": goods_name,
+        "operation_type": operation_type,
+        "quantity": quantity,
+        "notes": notes,
+        "timestamp": timestamp
+    })
+
+
+def validate_goods(goods_data):
+    """校验新增货物的必填字段，返回错误信息，通过时返回 None"""
+    for field in GOODS_REQUIRED_FIELDS:
+        if field not in goods_data or not goods_data[field]:
+            return f"缺少必填字段: {field}"
+    return None
+
+
+def goods_values(goods_data):
+    """从新增货物数据中取出入库字段，数值格式错误时抛出 ValueError"""
+    return {
+        "name": goods_data["name"],
+        "price": float(goods_data["price"]),
+        "location": goods_data["location"],
+        "quantity": int(goods_data.get("quantity", goods_data.get("stock", 0))),
+        "min_quantity": int(goods_data.get("min_quantity", 0)),
+        "description": goods_data.get("description", "")
+    }
+
+
+class RequestStream(io.RawIOBase):
+    """把 WSGI 输入流包装成标准二进制流（gunicorn 的请求体对象没有 readable/readinto）"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def iter_import_records(stream, fmt):
+    """逐行解析 CSV/NDJSON 导入数据，产出 (行号, 记录)，无法解析的行记录为 None"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            # CSV 中的空单元格视为未填写
+            yield reader.line_num, {k: v for k, v in row.items() if k and v not in ('', None)}
+        return
+    
+    for line_no, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_no, record if isinstance(record, dict) else None
+
+
+def upsert_goods_record(cursor, record, values, sku, timestamp):
+    """按 名称+位置 更新已有货物，只修改记录中提供的字段，返回更新的货物数
+    
+    库存有变化时按差额写入出入库历史，与其他库存修改一样可追溯。
+    """
+    cursor.execute('SELECT id, quantity FROM goods WHERE name = ? AND location = ?',
+                   (values["name"], values["location"]))
+    matches = cursor.fetchall()
+    
+    update_fields = ["price = ?"]
+    params = [values["price"]]
+    if "quantity" in record or "stock" in record:
+        update_fields += ["quantity = ?", "stock = ?"]
+        params += [values["quantity"], values["quantity"]]
+    if "min_quantity" in record:
+        update_fields.append("min_quantity = ?")
+        params.append(values["min_quantity"])
+    if "description" in record:
+        update_fields.append("description = ?")
+        params.append(values["description"])
+    if sku is not None:
+        update_fields.append("sku = ?")
+        params.append(sku)
+    update_fields.append("updated_at = ?")
+    params.append(timestamp)
+    
+    for row in matches:
+        cursor.execute(f"UPDATE goods SET {', '.join(update_fields)} WHERE id = ?", params + [row["id"]])
+        delta = values["quantity"] - row["quantity"]
+        if ("quantity" in record or "stock" in record) and delta:
+            add_history_record(values["name"], "入库" if delta > 0 else "出库", delta, "导入校正库存",
+                               cursor=cursor, goods_id=row["id"])
+    return len(matches)
+
+
+def import_goods(records, upsert=False):
+    """分批事务导入货物，upsert 时按 名称+位置 更新已有货物，返回导入统计和逐行错误"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    result = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    pending = 0
+    
+    def fail(line_no, message):
+        result["failed"] += 1
+        if len(result["errors"]) < IMPORT_MAX_ERRORS:
+            result["errors"].append({"line": line_no, "error": message})
+    
+    try:
+        for line_no, record in records:
+            if record is None:
+                fail(line_no, "无法解析的行")
+                continue
+            error = validate_goods(record)
+            if error:
+                fail(line_no, error)
+                continue
+            try:
+                values = goods_values(record)
+            except (TypeError, ValueError):
+                fail(line_no, "数值字段格式错误")
+                continue
+            try:
+                sku = normalize_sku(record.get("sku"))
+            except ValueError as e:
+                fail(line_no, str(e))
+                continue
+            
+            if not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            
+            # SKU 与其他货物重复时只跳过该行（约束错误只中止当前语句，不影响事务中的其他行）
+            try:
+                updated = 0
+                if upsert:
+                    updated = upsert_goods_record(cursor, record, values, sku, timestamp)
+                
+                if not updated:
+                    cursor.execute(
+                        '''INSERT INTO goods (name, sku, price, location, quantity, stock, min_quantity, description, created_at, updated_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (values["name"], sku, values["price"], values["location"], values["quantity"],
+                         values["quantity"], values["min_quantity"], values["description"], timestamp, timestamp)
+                    )
+            except sqlite3.IntegrityError:
+                fail(line_no, "SKU 已被其他货物使用")
+                continue
+            result["updated" if updated else "inserted"] += 1
+            pending += 1
+            
+            # 每 IMPORT_CHUNK_SIZE 行提交一次，避免长时间持有写锁
+            if pending >= IMPORT_CHUNK_SIZE:
+                conn.commit()
+                pending = 0
+        
+        conn.commit()
+    finally:
+        conn.close()
+    
+    return result
+
+
+def iter_goods_export(fmt, conn=None):
+    """按块读取货物并逐块产出 CSV/NDJSON 文本，内存占用与表大小无关；conn 为空时使用当前线程的连接"""
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(EXPORT_FIELDS)} FROM goods ORDER BY id")
+    
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+    
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        if fmt == 'csv':
+            writer.writerows(tuple(row) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+    
+    if fmt == 'csv' and buffer.tell():
+        yield buffer.getvalue()
+    conn.close()
+
+
+def goods_generation():
+    """读取货物表的当前修改代数（所有进程共享）"""
+    conn = get_db_connection()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'goods_generation'").fetchone()
+    conn.close()
+    return row[0]
+
+
+def not_modified_response(etag):
+    """返回 304 响应"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def iter_and_cache(chunks, generation, key):
+    """原样产出响应块，同时在总大小不超过缓存上限时把完整响应体放入货物缓存"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size <= goods_cache.max_bytes:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+    if parts is not None:
+        goods_cache.put(generation, key, ''.join(parts))
+
+
+def iter_json_rows(key, sql, params, to_dict, ndjson=False, conn=None):
+    """按块读取查询结果，逐块产出与 jsonify({key: [...]}) 相同的 JSON 文本，或每行一条的 NDJSON"""
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    dumps = app.json.dumps
+    
+    if not ndjson:
+        yield '{"' + key + '":['
+    first = True
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        if ndjson:
+            yield ''.join(dumps(to_dict(row), separators=(',', ':')) + '\n' for row in rows)
+        else:
+            chunk = ','.join(dumps(to_dict(row), separators=(',', ':')) for row in rows)
+            yield chunk if first else ',' + chunk
+            first = False
+    if not ndjson:
+        yield ']}\n'
+    conn.close()
+
+
+def iter_columnar_rows(key, sql, params, columns, conn=None):
+    """按块读取查询结果，逐块产出紧凑格式 {key: {"columns": [...], "rows": [[...]]}}"""
+    conn = conn or get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    
+    yield '{"' + key + '":{"columns":' + compact_dumps(columns) + ',"rows":['
+    first = True
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        chunk = compact_dumps([[row[c] for c in columns] for row in rows])[1:-1]
+        yield chunk if first else ',' + chunk
+        first = False
+    yield ']}}\n'
+    conn.close()
+
+
+def wants_ndjson():
+    """客户端是否要求 NDJSON 格式（format=ndjson 或 Accept: application/x-ndjson）"""
+    return (request.args.get('format') == 'ndjson'
+            or 'application/x-ndjson' in request.headers.get('Accept', ''))
+
+
+def stream_rows_response(key, sql, params, to_dict, cache_key=None, columns=None, conn=None):
+    """流式返回列表查询结果；传入 cache_key=(代数, 键) 时顺便缓存 JSON 响应体，传入 columns 时返回紧凑格式"""
+    ndjson = columns is None and wants_ndjson()
+    if columns is not None:
+        chunks = iter_columnar_rows(key, sql, params, columns, conn=conn)
+    else:
+        chunks = iter_json_rows(key, sql, params, to_dict, ndjson=ndjson, conn=conn)
+    if cache_key is not None and not ndjson:
+        chunks = iter_and_cache(chunks, *cache_key)
+    return Response(chunks, mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def data_format(fmt, content_type='', filename=''):
+    """确定导入/导出格式：显式参数优先，其次 Content-Type 或文件扩展名，默认 CSV"""
+    fmt = (fmt or '').lower()
+    if not fmt:
+        if 'ndjson' in content_type or 'jsonl' in content_type or filename.endswith(('.ndjson', '.jsonl')):
+            fmt = 'ndjson'
+        else:
+            fmt = 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError("format 只能是 csv 或 ndjson")
+    return fmt
+
+
+class StockError(Exception):
+    """库存操作失败，status 为对应的 HTTP 状态码"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def update_stock(cursor, goods_id, quantity, timestamp):
+    """在调用方事务中增减库存，quantity 为负数表示出库，返回更新后的货物行"""
+    if quantity >= 0:
+        cursor.execute(
+            'UPDATE goods SET quantity = quantity + ?, stock = quantity + ?, updated_at = ? WHERE id = ? RETURNING ' + GOODS_RETURNING,
+            (quantity, quantity, timestamp, goods_id)
+        )
+    else:
+        # 库存检查与扣减在同一条语句中完成，并发出库不会超卖
+        cursor.execute(
+            '''UPDATE goods SET quantity = quantity - ?, stock = quantity - ?, updated_at = ?
+               WHERE id = ? AND quantity >= ? RETURNING ''' + GOODS_RETURNING,
+            (-quantity, -quantity, timestamp, goods_id, -quantity)
+        )
+    goods = cursor.fetchone()
+    
+    if goods is None:
+        cursor.execute('SELECT quantity FROM goods WHERE id = ?', (goods_id,))
+        current = cursor.fetchone()
+        if current is None:
+            raise StockError("货物不存在", 404)
+        raise StockError(f"库存不足，当前库存: {current['quantity']}")
+    return goods
+
+
+def move_stock(cursor, goods_id, quantity, notes=""):
+    """在调用方事务中增减库存并写入历史记录，返回更新后的货物行"""
+    goods = update_stock(cursor, goods_id, quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    add_history_record(goods["name"], "入库" if quantity >= 0 else "出库", quantity, notes,
+                       cursor=cursor, goods_id=goods["id"])
+    return goods
+
+
+class StockCommitQueue:
+    """合并提交：请求线程把出入库放入队列并等待结果，写线程把一个时间窗口内到达的出入库放在一个事务中提交
+    
+    每个出入库在自己的 SAVEPOINT 中执行，库存不足只回滚该项；事务提交成功后才把结果交给请求线程，
+    提交失败时同一批的请求都返回错误。
+    """
+    
+    def __init__(self, window_ms=STOCK_GROUP_WINDOW_MS, max_items=STOCK_GROUP_MAX):
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.groups = 0
+    
+    def submit(self, goods_id, quantity, notes=""):
+        """提交一次入库/出库并等待提交完成，返回更新后的货物行；失败时抛出 StockError"""
+        self.start()
+        future = Future()
+        self.queue.put((goods_id, quantity, notes, future))
+        return future.result()
+    
+    def start(self):
+        """每个进程第一次提交时启动写线程"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                threading.Thread(target=self.run, name="stock-writer", daemon=True).start()
+                self.pid = os.getpid()
+    
+    def run(self):
+        conn = open_db_connection()
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_items:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.commit(conn, batch)
+            self.groups += 1
+            if METRICS_ENABLED:
+                metrics.observe("warehouse_stock_group_commit_size", ROWS_BUCKETS, (), len(batch))
+    
+    @staticmethod
+    def commit(conn, batch):
+        """在一个事务中执行一批出入库"""
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            for goods_id, quantity, notes, future in batch:
+                cursor.execute('SAVEPOINT movement')
+                try:
+                    results.append((future, move_stock(cursor, goods_id, quantity, notes), None))
+                except StockError as e:
+                    cursor.execute('ROLLBACK TO movement')
+                    results.append((future, None, e))
+                cursor.execute('RELEASE movement')
+            conn.commit()
+        except Exception as e:
+            conn.close()
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+        
+        for future, goods, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(goods)
+
+
+stock_commit_queue = StockCommitQueue()
+
+
+def stock_movement_response(goods_id, quantity, notes):
+    """执行单次入库/出库（一个 BEGIN IMMEDIATE 事务，开启合并提交时与其他请求共用事务）并返回接口响应"""
+    if STOCK_GROUP_COMMIT:
+        try:
+            goods = stock_commit_queue.submit(goods_id, quantity, notes)
+        except StockError as e:
+            return jsonify({"error": str(e)}), e.status
+        return jsonify({"success": True, "goods": goods_to_dict(goods)})
+    
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        goods = move_stock(conn.cursor(), goods_id, quantity, notes)
+        conn.commit()
+    except StockError as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), e.status
+    finally:
+        conn.close()
+    
+    return jsonify({"success": True, "goods": goods_to_dict(goods)})
+
+
+# ============ 紧凑格式与响应压缩 ============
+
+def compact_dumps(obj):
+    """紧凑格式的 JSON 编码：有 orjson 时使用 orjson，否则用标准库（不转义中文、不加空格）"""
+    start = time.perf_counter()
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj).decode('utf-8')
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    finally:
+        record_json_time(start)
+
+
+def wants_columnar():
+    """客户端是否要求紧凑格式（format=columnar）"""
+    return request.args.get('format') == 'columnar'
+
+
+def requested_columns(key, fields):
+    """format=columnar 时返回 {key: 列}（fields= 可选择部分列），否则返回 None"""
+    if not wants_columnar():
+        return None
+    columns = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or fields
+    unknown = [c for c in columns if c not in fields]
+    if unknown:
+        raise ValueError(f"未知字段: {', '.join(unknown)}")
+    return {key: columns}
+
+
+def list_response(data, columns=None):
+    """返回列表接口的响应；columns={键: 列} 时把 data 中这些键的行列表转为列式数组，用紧凑编码返回"""
+    if columns is None:
+        return jsonify(data)
+    for key, names in columns.items():
+        data[key] = {"columns": names, "rows": [[item[c] for c in names] for item in data[key]]}
+    return Response(compact_dumps(data) + '\n', mimetype='application/json')
+
+
+def iter_compressed(chunks, encoding):
+    """逐块压缩流式响应"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def accepted_encoding():
+    """按 Accept-Encoding 选择压缩方式（优先 brotli，其次 gzip），不压缩时返回 None"""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+
+def compress_body(body, encoding):
+    """一次性压缩完整的响应体"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+@app.after_request
+def compress_response(response):
+    """客户端支持时压缩较大的响应（优先 brotli，其次 gzip），解压后的内容与未压缩时相同"""
+    if (not COMPRESS_ENABLED or response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = iter_compressed(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    
+    # 压缩后的字节与原响应不同，ETag 改为弱校验（If-None-Match 按弱比较匹配）
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ============ 只读快照 ============
+
+class SnapshotCancelled(Exception):
+    """快照任务被取消"""
+
+
+def backup_database(path, job_id=None):
+    """用 SQLite 在线备份 API 把主库分步复制到 path（先写临时文件，完成后替换），返回快照信息
+    
+    复制前在源连接上开启读事务，每一步都读取同一个 WAL 快照：写入不会被阻塞，也不会让备份从头开始；
+    备份期间 WAL 检查点无法越过该快照，WAL 文件会暂时变大。传入 job_id 时每步更新任务进度。
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    source = open_db_connection()
+    job_conn = open_db_connection() if job_id is not None else None
+    target = sqlite3.connect(tmp_path)
+    start = time.perf_counter()
+    
+    def progress(status, remaining, total):
+        if job_conn is not None:
+            if job_conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()["status"] == "cancelling":
+                raise SnapshotCancelled()
+            update_job(job_conn, job_id, total=total, processed=total - remaining)
+        time.sleep(SNAPSHOT_STEP_PAUSE)
+    
+    try:
+        source.execute('BEGIN')
+        taken_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        seq = source.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+        pages = source.execute('PRAGMA page_count').fetchone()[0]
+        try:
+            source.backup(target, pages=SNAPSHOT_PAGES, progress=progress)
+        except SnapshotCancelled:
+            update_job(job_conn, job_id, status="cancelled")
+            return None
+        source.rollback()
+        
+        # 快照只读，不需要 WAL；快照时间写入快照自身，所有进程读到的一致
+        target.execute('PRAGMA journal_mode = DELETE')
+        target.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                           [('snapshot_taken_at', taken_at), ('snapshot_seq', seq)])
+        target.commit()
+        target.close()
+        os.replace(tmp_path, path)
+        if job_conn is not None:
+            update_job(job_conn, job_id, status="done")
+    finally:
+        target.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        source.shutdown()
+        if job_conn is not None:
+            job_conn.shutdown()
+    
+    return {"taken_at": taken_at, "seq": seq, "pages": pages, "seconds": time.perf_counter() - start}
+
+
+def open_snapshot():
+    """打开最新快照的只读连接，快照不存在时返回 None"""
+    if not os.path.exists(SNAPSHOT_PATH):
+        return None
+    conn = sqlite3.connect(f"file:{urllib.request.pathname2url(SNAPSHOT_PATH)}?mode=ro", uri=True,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def snapshot_info(conn):
+    """读取快照的生成时间、对应的变更序号，以及距今秒数"""
+    meta = dict(conn.execute(
+        "SELECT key, value FROM meta WHERE key IN ('snapshot_taken_at', 'snapshot_seq')"
+    ).fetchall())
+    taken_at = meta.get('snapshot_taken_at')
+    age = None
+    if taken_at:
+        age = int((datetime.now() - datetime.strptime(taken_at, "%Y-%m-%d %H:%M:%S")).total_seconds())
+    return {"taken_at": taken_at, "seq": int(meta.get('snapshot_seq', 0)), "age_seconds": age}
+
+
+def snapshot_connection():
+    """请求带 snapshot=1 时返回最新快照的只读连接，并记录快照信息供响应头使用；否则或快照不存在时返回 None"""
+    if request.args.get('snapshot', '').lower() not in ('1', 'true', 'yes'):
+        return None
+    conn = open_snapshot()
+    if conn is not None:
+        request.environ["warehouse.snapshot"] = snapshot_info(conn)
+    return conn
+
+
+@app.after_request
+def snapshot_headers(response):
+    """读取快照的响应在响应头中标明数据截至时间；没有这些响应头表示读取的是主库"""
+    snapshot = request.environ.get("warehouse.snapshot")
+    if snapshot is not None:
+        response.headers['X-Snapshot-Time'] = snapshot["taken_at"] or ''
+        response.headers['X-Snapshot-Age'] = str(snapshot["age_seconds"])
+        response.headers['X-Snapshot-Seq'] = str(snapshot["seq"])
+    return response
+
+
+def claim_snapshot(conn):
+    """领取到期的快照刷新：多个进程同时运行时每个周期只有一个进程执行"""
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute("SELECT value FROM meta WHERE key = 'snapshot_next_at'").fetchone()
+    if row is not None and float(row[0]) > now:
+        conn.rollback()
+        return False
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('snapshot_next_at', ?)",
+                 (now + SNAPSHOT_INTERVAL,))
+    conn.commit()
+    return True
+
+
+def run_snapshot_scheduler():
+    """后台线程：每隔 SNAPSHOT_INTERVAL 秒刷新一次快照"""
+    conn = open_db_connection()
+    while True:
+        try:
+            if claim_snapshot(conn):
+                backup_database(SNAPSHOT_PATH)
+        except (sqlite3.Error, OSError) as e:
+            conn.close()
+            app.logger.warning("快照刷新失败: %s", e)
+        time.sleep(min(SNAPSHOT_INTERVAL, 60))
+
+
+def start_snapshot_scheduler():
+    """配置了 SNAPSHOT_INTERVAL 时启动快照刷新线程"""
+    if SNAPSHOT_INTERVAL > 0:
+        threading.Thread(target=run_snapshot_scheduler, name="snapshot-scheduler", daemon=True).start()
+
+
+# ============ 低库存告警 ============
+
+def alert_to_dict(row):
+    """将告警行（关联货物名称）转换为接口返回的字典"""
+    return {
+        "id": row["id"],
+        "goods_id": row["goods_id"],
+        "name": row["name"],
+        "status": row["status"],
+        "quantity": row["quantity"],
+        "min_quantity": row["min_quantity"],
+        "opened_at": row["opened_at"],
+        "resolved_at": row["resolved_at"]
+    }
+
+
+def post_alert(payload):
+    """把一条告警通知 POST 到 ALERT_WEBHOOK_URL，非 2xx 响应抛出异常"""
+    req = urllib.request.Request(
+        ALERT_WEBHOOK_URL, data=payload.encode('utf-8'), method='POST',
+        headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=5):
+        pass
+
+
+def dispatch_alerts(conn):
+    """投递发件箱中到期的告警通知，返回成功条数；失败的按指数退避重试"""
+    now = datetime.now()
+    # 先把待投递的行往后推一段时间再投递，多个进程同时运行时同一条通知不会被重复领取
+    lease = (now + timedelta(seconds=60)).strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute('BEGIN IMMEDIATE')
+    rows = conn.execute('''
+        UPDATE alert_outbox SET next_attempt_at = ?, attempts = attempts + 1
+        WHERE id IN (SELECT id FROM alert_outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT 100)
+        RETURNING id, payload, attempts
+    ''', (lease, now.strftime("%Y-%m-%d %H:%M:%S"))).fetchall()
     conn.commit()
     
-    # 获取更新后的数据
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    updated_goods = cursor.fetchone()
+    delivered = 0
+    for row in sorted(rows, key=lambda r: r["id"]):
+        try:
+            post_alert(row["payload"])
+        except Exception as e:
+            delay = min(2 ** row["attempts"], ALERT_RETRY_MAX_DELAY)
+            retry_at = (datetime.now() + timedelta(seconds=delay)).strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute('UPDATE alert_outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?',
+                         (retry_at, str(e), row["id"]))
+        else:
+            conn.execute('DELETE FROM alert_outbox WHERE id = ?', (row["id"],))
+            delivered += 1
+        conn.commit()
+    return delivered
+
+
+def run_alert_dispatcher():
+    """后台线程：定期投递告警通知"""
+    conn = open_db_connection()
+    while True:
+        try:
+            dispatch_alerts(conn)
+        except sqlite3.Error:
+            conn.close()
+        time.sleep(ALERT_DISPATCH_INTERVAL)
+
+
+def start_alert_dispatcher():
+    """配置了 ALERT_WEBHOOK_URL 时启动告警投递线程"""
+    if ALERT_WEBHOOK_URL:
+        threading.Thread(target=run_alert_dispatcher, name="alert-dispatcher", daemon=True).start()
+
+
+# ============ 实时事件 ============
+
+class EventBroker:
+    """轮询事件表，把新事件放入有界缓冲区并唤醒本进程的 SSE 订阅者
+    
+    事件表是唯一来源：多进程部署时每个进程各自轮询，任何进程提交的修改都能推送到所有订阅者。
+    """
+    
+    def __init__(self, buffer_size):
+        self.buffer = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.last_seq = 0
+        self.subscribers = 0
+        self.thread = None
+        self.closed = False
+        # 有新事件或关闭时在轮询线程中调用的回调（ASGI 前端用来唤醒协程）
+        self.listeners = []
+    
+    def start(self):
+        """首次订阅时启动轮询线程"""
+        with self.condition:
+            if self.thread is not None:
+                return
+            conn = get_db_connection()
+            self.last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM events').fetchone()[0]
+            conn.close()
+            self.thread = threading.Thread(target=self.run, name="event-broker", daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        conn = open_db_connection()
+        while True:
+            try:
+                rows = conn.execute(
+                    'SELECT seq, type, data FROM events WHERE seq > ? ORDER BY seq LIMIT ?',
+                    (self.last_seq, self.buffer.maxlen)
+                ).fetchall()
+            except sqlite3.Error:
+                rows = []
+                conn.close()
+            
+            if rows:
+                with self.condition:
+                    self.buffer.extend((row["seq"], row["type"], row["data"]) for row in rows)
+                    self.last_seq = rows[-1]["seq"]
+                    self.condition.notify_all()
+                for listener in self.listeners:
+                    listener()
+            if len(rows) < self.buffer.maxlen:
+                time.sleep(EVENTS_POLL_INTERVAL)
+    
+    def events_after(self, seq):
+        """返回缓冲区中 seq 之后的事件；这些事件不在缓冲区中（已被挤出或早于启动）时返回 None"""
+        with self.condition:
+            if seq < self.last_seq and (not self.buffer or self.buffer[0][0] > seq + 1):
+                return None
+            return [event for event in self.buffer if event[0] > seq]
+    
+    def wait(self, seq, timeout):
+        """等待 seq 之后的新事件，超时返回 False"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last_seq > seq or self.closed, timeout)
+    
+    def close(self):
+        """进程退出前结束所有订阅连接，服务器可以按时完成平滑关闭"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+
+event_broker = EventBroker(EVENTS_BUFFER_SIZE)
+
+
+def prune_events(conn):
+    """删除事件表中最近 EVENTS_RETENTION 条以前的事件，返回删除条数"""
+    deleted = conn.execute('DELETE FROM events WHERE seq <= (SELECT MAX(seq) FROM events) - ?',
+                           (EVENTS_RETENTION,)).rowcount
+    conn.commit()
+    return deleted
+
+
+def run_event_pruner():
+    """后台线程：定期清理事件表（与是否有订阅者无关，没有订阅者时事件表同样会增长）"""
+    conn = open_db_connection()
+    while True:
+        try:
+            prune_events(conn)
+        except sqlite3.Error:
+            conn.close()
+        time.sleep(EVENTS_PRUNE_INTERVAL)
+
+
+def start_event_pruner():
+    """启动事件表清理线程"""
+    threading.Thread(target=run_event_pruner, name="event-pruner", daemon=True).start()
+
+
+def load_events_after(seq):
+    """从事件表读取 seq 之后的一批事件；seq 之后的事件已被清理时返回 None"""
+    conn = get_db_connection()
+    oldest = conn.execute('SELECT MIN(seq) FROM events').fetchone()[0]
+    rows = conn.execute(
+        'SELECT seq, type, data FROM events WHERE seq > ? ORDER BY seq LIMIT ?', (seq, EVENTS_BUFFER_SIZE)
+    ).fetchall()
     conn.close()
+    if oldest is not None and oldest > seq + 1:
+        return None
+    return [(row["seq"], row["type"], row["data"]) for row in rows]
+
+
+def iter_events(seq):
+    """产出 seq 之后的 SSE 事件；跟不上的订阅者从事件表补读，补读不到时发送 reset 事件"""
+    yield "retry: 3000\n\n"
+    while not event_broker.closed:
+        events = event_broker.events_after(seq)
+        if events is None:
+            events = load_events_after(seq)
+        if events is None:
+            # 缺失的事件已被清理，客户端需要重新拉取 /api/goods
+            seq = event_broker.last_seq
+            yield f"id: {seq}\nevent: reset\ndata: {{}}\n\n"
+            continue
+        
+        for event_seq, event_type, data in events:
+            yield f"id: {event_seq}\nevent: {event_type}\ndata: {data}\n\n"
+            seq = event_seq
+        if not events and not event_broker.wait(seq, EVENTS_KEEPALIVE):
+            yield ": keepalive\n\n"
+
+
+def release_subscriber():
+    """释放一个订阅名额"""
+    with event_broker.condition:
+        event_broker.subscribers -= 1
+
+
+# 主页
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+
+# 健康检查
+@app.route('/api/health', methods=['GET'])
+def health():
+    try:
+        conn = get_db_connection()
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        conn.close()
+    except sqlite3.Error as e:
+        return jsonify({"status": "error", "error": str(e)}), 503
+    return jsonify({
+        "status": "ok",
+        "journal_mode": journal_mode,
+        "connections": len(_all_connections)
+    })
+
+
+# Prometheus 指标（每个进程各自统计）
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "监控指标未启用"}), 404
+    body = metrics.render(gauges=[("warehouse_db_connections", len(_all_connections))])
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+# ============ 货物管理API ============
+
+# 获取所有货物（带分页/筛选参数时按游标分页）
+@app.route('/api/goods', methods=['GET'])
+def get_goods():
+    if not any(param in request.args for param in GOODS_PAGE_PARAMS):
+        # 货物表未修改时直接返回 304 或缓存的响应体
+        generation = goods_generation()
+        columns = GOODS_COMPACT_FIELDS if wants_columnar() else None
+        variant = "columnar" if columns else "ndjson" if wants_ndjson() else ""
+        etag = f"goods-{generation}" + (f"-{variant}" if variant else "")
+        if request.if_none_match.contains_weak(etag):
+            return not_modified_response(etag)
+        
+        cache_key = "list-columnar" if columns else "list"
+        body = None if variant == "ndjson" else goods_cache.get(generation, cache_key)
+        if body is not None:
+            encoding = accepted_encoding() if COMPRESS_ENABLED and len(body) >= COMPRESS_MIN_SIZE else None
+            if encoding is not None:
+                # 压缩结果按编码缓存在同一代数下，命中缓存时不必每次重新压缩
+                compressed = goods_cache.get(generation, (cache_key, encoding))
+                if compressed is None:
+                    compressed = compress_body(body.encode('utf-8'), encoding)
+                    goods_cache.put(generation, (cache_key, encoding), compressed)
+                response = Response(compressed, mimetype='application/json')
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                response.set_etag(etag, weak=True)
+                return response
+            response = Response(body, mimetype='application/json')
+        else:
+            response = stream_rows_response(
+                "goods", 'SELECT * FROM goods ORDER BY id', (), goods_to_dict,
+                cache_key=(generation, cache_key), columns=columns
+            )
+        response.set_etag(etag)
+        return response
+    
+    try:
+        columns = requested_columns("goods", GOODS_COMPACT_FIELDS)
+        data = query_goods_page(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(data, columns)
+
+
+# 根据 _id 获取货物（兼容小程序）
+@app.route('/api/goods/by/_id/<string:goods_id>', methods=['GET'])
+def get_goods_by_uuid(goods_id):
+    goods_id = resolve_id(goods_id)
+    if goods_id is None:
+        return jsonify({"error": "货物不存在"}), 404
+    
+    generation = goods_generation()
+    etag = f"goods-{generation}-{goods_id}"
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+    
+    body = goods_cache.get(generation, goods_id)
+    if body is None:
+        goods = fetch_goods_by_ids([goods_id]).get(goods_id)
+        if not goods:
+            return jsonify({"error": "货物不存在"}), 404
+        body = app.json.dumps(goods_to_dict(goods), separators=(',', ':')) + '\n'
+        goods_cache.put(generation, goods_id, body)
+    
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+# 搜索货物
+@app.route('/api/goods/search', methods=['GET'])
+def search_goods():
+    query = request.args.get('q', '').strip()
+    try:
+        columns = requested_columns("goods", GOODS_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    return jsonify({
-        "success": True,
-        "goods": {
-            "id": updated_goods["id"],
-            "_id": str(updated_goods["id"]),
-            "name": updated_goods["name"],
-            "price": updated_goods["price"],
-            "location": updated_goods["location"],
-            "quantity": updated_goods["quantity"],
-            "stock": updated_goods["stock"],
-            "min_quantity": updated_goods["min_quantity"],
-            "description": updated_goods["description"],
-            "created_at": updated_goods["created_at"],
-            "updated_at": updated_goods["updated_at"]
-        }
-    })
+    if not query:
+        data = load_goods()
+        return list_response(data, columns)
+    
+    # 全文检索
+    try:
+        rows, next_offset = search_rows("goods", query, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    data = {"goods": [goods_to_dict(row) for row in rows]}
+    if 'limit' in request.args:
+        data["next_offset"] = next_offset
+    return list_response(data, columns)
+
+
+# 根据 _id 批量获取货物，ids 以逗号分隔，按请求顺序返回，不存在的 id 列在 missing 中
+@app.route('/api/goods/by/_id', methods=['GET'])
+def get_goods_by_uuids():
+    raw_ids = list(dict.fromkeys(v.strip() for v in request.args.get('ids', '').split(',') if v.strip()))
+    if not raw_ids:
+        return jsonify({"error": "ids 不能为空"}), 400
+    if len(raw_ids) > GOODS_BATCH_MAX:
+        return jsonify({"error": f"单次最多查询 {GOODS_BATCH_MAX} 个货物"}), 400
+    
+    try:
+        columns = requested_columns("goods", GOODS_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    ids = [resolve_id(v) for v in raw_ids]
+    found = fetch_goods_by_ids([i for i in ids if i is not None])
+    return list_response({
+        "goods": [goods_to_dict(found[i]) for i in ids if i in found],
+        "missing": [v for v, i in zip(raw_ids, ids) if i not in found]
+    }, columns)
+
+
+# 扫码：根据条码/SKU 获取货物
+@app.route('/api/goods/by/sku/<string:code>', methods=['GET'])
+def get_goods_by_sku(code):
+    try:
+        code = normalize_sku(code)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    goods = fetch_goods_by_skus([code]).get(code) if code else None
+    if not goods:
+        return jsonify({"error": "货物不存在"}), 404
+    return jsonify(goods_to_dict(goods))
+
+
+# 批量扫码：codes 以逗号分隔（GET），或请求体 {"codes": [...]}（POST），按请求顺序返回，未找到的列在 missing 中
+@app.route('/api/goods/by/sku', methods=['GET', 'POST'])
+def get_goods_by_skus():
+    if request.method == 'POST':
+        post_data = request.get_json(silent=True)
+        raw_codes = post_data.get("codes") if isinstance(post_data, dict) else None
+        if not isinstance(raw_codes, list):
+            return jsonify({"error": "codes 必须是数组"}), 400
+    else:
+        raw_codes = request.args.get('codes', '').split(',')
+    try:
+        codes = list(dict.fromkeys(c for c in (normalize_sku(v) for v in raw_codes) if c))
+        columns = requested_columns("goods", GOODS_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not codes:
+        return jsonify({"error": "codes 不能为空"}), 400
+    if len(codes) > GOODS_BATCH_MAX:
+        return jsonify({"error": f"单次最多查询 {GOODS_BATCH_MAX} 个条码"}), 400
+    
+    found = fetch_goods_by_skus(codes)
+    return list_response({
+        "goods": [goods_to_dict(found[c]) for c in codes if c in found],
+        "missing": [c for c in codes if c not in found]
+    }, columns)
+
+
+# 根据 _id 修改货物（兼容小程序）
+@app.route('/api/goods/by/_id/<string:goods_id>', methods=['PUT'])
+def update_goods_by_uuid(goods_id):
+    goods_id = resolve_id(goods_id)
+    if goods_id is None:
+        return jsonify({"error": "货物不存在"}), 404
+    return update_goods_record(goods_id, request.get_json())
 
 
 # 根据 _id 删除货物（兼容小程序）
 @app.route('/api/goods/by/_id/<string:goods_id>', methods=['DELETE'])
 def delete_goods_by_uuid(goods_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
+    goods_id = resolve_id(goods_id)
+    if goods_id is None:
         return jsonify({"error": "货物不存在"}), 404
-    
-    deleted_goods = {
-        "id": goods["id"],
-        "_id": str(goods["id"]),
-        "name": goods["name"],
-        "price": goods["price"],
-        "location": goods["location"],
-        "quantity": goods["quantity"],
-        "stock": goods["stock"],
-        "min_quantity": goods["min_quantity"],
-        "description": goods["description"],
-        "created_at": goods["created_at"],
-        "updated_at": goods["updated_at"]
-    }
-    
-    cursor.execute('DELETE FROM goods WHERE id = ?', (goods_id,))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"success": True, "goods": deleted_goods})
+    return delete_goods_record(goods_id)
 
 
 # 添加货物
@@ -308,10 +3049,13 @@ def add_goods():
     goods_data = request.get_json()
     
     # 验证必填字段
-    required_fields = ['name', 'price', 'location']
-    for field in required_fields:
-        if field not in goods_data or not goods_data[field]:
-            return jsonify({"error": f"缺少必填字段: {field}"}), 400
+    error = validate_goods(goods_data)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        sku = normalize_sku(goods_data.get("sku"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -319,151 +3063,81 @@ def add_goods():
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     quantity = int(goods_data.get("quantity", goods_data.get("stock", 0)))
     
-    cursor.execute(
-        '''INSERT INTO goods (name, price, location, quantity, stock, min_quantity, description, created_at, updated_at) 
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (
-            goods_data["name"],
-            float(goods_data["price"]),
-            goods_data["location"],
-            quantity,
-            quantity,
-            int(goods_data.get("min_quantity", 0)),
-            goods_data.get("description", ""),
-            timestamp,
-            timestamp
+    try:
+        cursor.execute(
+            '''INSERT INTO goods (name, sku, price, location, quantity, stock, min_quantity, description, created_at, updated_at) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING ''' + GOODS_RETURNING,
+            (
+                goods_data["name"],
+                sku,
+                float(goods_data["price"]),
+                goods_data["location"],
+                quantity,
+                quantity,
+                int(goods_data.get("min_quantity", 0)),
+                goods_data.get("description", ""),
+                timestamp,
+                timestamp
+            )
         )
-    )
-    
-    new_id = cursor.lastrowid
+        new_goods = cursor.fetchone()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": "SKU 已被其他货物使用"}), 409
     conn.commit()
     conn.close()
     
-    new_goods = {
-        "id": new_id,
-        "_id": str(new_id),
-        "name": goods_data["name"],
-        "price": float(goods_data["price"]),
-        "location": goods_data["location"],
-        "quantity": quantity,
-        "stock": quantity,
-        "min_quantity": int(goods_data.get("min_quantity", 0)),
-        "description": goods_data.get("description", ""),
-        "created_at": timestamp,
-        "updated_at": timestamp
-    }
-    
-    return jsonify({"success": True, "goods": new_goods})
+    if sku:
+        sku_index.put(sku, new_goods["id"])
+    return jsonify({"success": True, "goods": goods_to_dict(new_goods)})
+
+
+# 批量导入货物（请求体为 CSV 或 NDJSON，流式解析、分批提交）
+@app.route('/api/goods/import', methods=['POST'])
+def import_goods_api():
+    try:
+        fmt = data_format(request.args.get('format'), request.content_type or '')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    upsert = request.args.get('upsert', '').lower() in ('1', 'true', 'yes')
+    
+    records = iter_import_records(io.BufferedReader(RequestStream(request.stream)), fmt)
+    result = import_goods(records, upsert=upsert)
+    return jsonify({"success": True, **result})
+
+
+# 导出货物（流式输出 CSV 或 NDJSON）
+@app.route('/api/goods/export', methods=['GET'])
+def export_goods_api():
+    try:
+        fmt = data_format(request.args.get('format'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if fmt == 'csv':
+        mimetype = 'text/csv'
+        filename = 'goods.csv'
+    else:
+        mimetype = 'application/x-ndjson'
+        filename = 'goods.ndjson'
+    return Response(
+        iter_goods_export(fmt, snapshot_connection()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 
 # 修改货物
 @app.route('/api/goods/<int:goods_id>', methods=['PUT'])
 def update_goods(goods_id):
-    goods_data = request.get_json()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 先查询货物
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
-        return jsonify({"error": "货物不存在"}), 404
-    
-    # 构建更新语句
-    update_fields = []
-    params = []
-    
-    if "name" in goods_data:
-        update_fields.append("name = ?")
-        params.append(goods_data["name"])
-    if "price" in goods_data:
-        update_fields.append("price = ?")
-        params.append(float(goods_data["price"]))
-    if "location" in goods_data:
-        update_fields.append("location = ?")
-        params.append(goods_data["location"])
-    if "quantity" in goods_data:
-        update_fields.append("quantity = ?")
-        update_fields.append("stock = ?")
-        params.append(int(goods_data["quantity"]))
-        params.append(int(goods_data["quantity"]))
-    elif "stock" in goods_data:
-        update_fields.append("stock = ?")
-        update_fields.append("quantity = ?")
-        params.append(int(goods_data["stock"]))
-        params.append(int(goods_data["stock"]))
-    if "min_quantity" in goods_data:
-        update_fields.append("min_quantity = ?")
-        params.append(int(goods_data["min_quantity"]))
-    if "description" in goods_data:
-        update_fields.append("description = ?")
-        params.append(goods_data["description"])
-    
-    update_fields.append("updated_at = ?")
-    params.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    
-    params.append(goods_id)
-    
-    cursor.execute(f"UPDATE goods SET {', '.join(update_fields)} WHERE id = ?", params)
-    conn.commit()
-    
-    # 获取更新后的数据
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    updated_goods = cursor.fetchone()
-    conn.close()
-    
-    return jsonify({
-        "success": True,
-        "goods": {
-            "id": updated_goods["id"],
-            "_id": str(updated_goods["id"]),
-            "name": updated_goods["name"],
-            "price": updated_goods["price"],
-            "location": updated_goods["location"],
-            "quantity": updated_goods["quantity"],
-            "stock": updated_goods["stock"],
-            "min_quantity": updated_goods["min_quantity"],
-            "description": updated_goods["description"],
-            "created_at": updated_goods["created_at"],
-            "updated_at": updated_goods["updated_at"]
-        }
-    })
+    return update_goods_record(goods_id, request.get_json())
 
 
 # 删除货物
 @app.route('/api/goods/<int:goods_id>', methods=['DELETE'])
 def delete_goods(goods_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
-        return jsonify({"error": "货物不存在"}), 404
-    
-    deleted_goods = {
-        "id": goods["id"],
-        "_id": str(goods["id"]),
-        "name": goods["name"],
-        "price": goods["price"],
-        "location": goods["location"],
-        "quantity": goods["quantity"],
-        "stock": goods["stock"],
-        "min_quantity": goods["min_quantity"],
-        "description": goods["description"],
-        "created_at": goods["created_at"],
-        "updated_at": goods["updated_at"]
-    }
-    
-    cursor.execute('DELETE FROM goods WHERE id = ?', (goods_id,))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"success": True, "goods": deleted_goods})
+    return delete_goods_record(goods_id)
 
 
 # ============ 库存操作API ============
@@ -477,50 +3151,7 @@ def stock_in(goods_id):
     if quantity <= 0:
         return jsonify({"error": "数量必须大于0"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
-        return jsonify({"error": "货物不存在"}), 404
-    
-    new_quantity = goods["quantity"] + quantity
-    cursor.execute('UPDATE goods SET quantity = ?, stock = ?, updated_at = ? WHERE id = ?',
-                   (new_quantity, new_quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), goods_id))
-    conn.commit()
-    
-    # 记录操作历史
-    add_history_record(
-        goods["name"],
-        "入库",
-        quantity,
-        post_data.get("notes", "")
-    )
-    
-    # 获取更新后的数据
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    updated_goods = cursor.fetchone()
-    conn.close()
-    
-    return jsonify({
-        "success": True,
-        "goods": {
-            "id": updated_goods["id"],
-            "_id": str(updated_goods["id"]),
-            "name": updated_goods["name"],
-            "price": updated_goods["price"],
-            "location": updated_goods["location"],
-            "quantity": updated_goods["quantity"],
-            "stock": updated_goods["stock"],
-            "min_quantity": updated_goods["min_quantity"],
-            "description": updated_goods["description"],
-            "created_at": updated_goods["created_at"],
-            "updated_at": updated_goods["updated_at"]
-        }
-    })
+    return stock_movement_response(goods_id, quantity, post_data.get("notes", ""))
 
 
 # 货物出库（取出）
@@ -532,54 +3163,86 @@ def stock_out(goods_id):
     if quantity <= 0:
         return jsonify({"error": "数量必须大于0"}), 400
     
+    return stock_movement_response(goods_id, -quantity, post_data.get("notes", ""))
+
+
+# 批量入库/出库（扫码枪批量同步）
+# 请求体: {"items": [{"goods_id", "op": "in"|"out", "quantity", "notes"}], "mode": "atomic"|"partial"}
+# atomic 模式任一行失败则整批回滚；partial 模式只跳过失败的行
+@app.route('/api/stock/batch', methods=['POST'])
+def stock_batch():
+    post_data = request.get_json()
+    if isinstance(post_data, list):
+        post_data = {"items": post_data}
+    items = post_data.get("items") if isinstance(post_data, dict) else None
+    mode = post_data.get("mode", "atomic") if isinstance(post_data, dict) else "atomic"
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items 不能为空"}), 400
+    if len(items) > STOCK_BATCH_MAX:
+        return jsonify({"error": f"单批最多 {STOCK_BATCH_MAX} 行"}), 400
+    if mode not in ("atomic", "partial"):
+        return jsonify({"error": "mode 只能是 atomic 或 partial"}), 400
+    
     conn = get_db_connection()
     cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    goods = cursor.fetchone()
-    
-    if not goods:
-        conn.close()
-        return jsonify({"error": "货物不存在"}), 404
-    
-    if goods["quantity"] < quantity:
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    history_rows = []
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for item in items:
+            try:
+                op = STOCK_BATCH_OPS.get(item.get("op"))
+                goods_id = int(item.get("goods_id"))
+                quantity = int(item.get("quantity", 0))
+            except (AttributeError, TypeError, ValueError):
+                results.append({"ok": False, "error": "行格式错误"})
+                continue
+            if op is None:
+                results.append({"ok": False, "error": "op 只能是 in 或 out"})
+                continue
+            if quantity <= 0:
+                results.append({"ok": False, "error": "数量必须大于0"})
+                continue
+            notes = item.get("notes", "")
+            if notes is None:
+                notes = ""
+            if not isinstance(notes, str):
+                results.append({"ok": False, "error": "notes 必须是字符串"})
+                continue
+            
+            delta = quantity if op == "入库" else -quantity
+            try:
+                goods = update_stock(cursor, goods_id, delta, timestamp)
+            except StockError as e:
+                results.append({"ok": False, "error": str(e)})
+                continue
+            
+            history_rows.append((goods_id, goods["name"], op, delta, notes, timestamp))
+            results.append({"ok": True, "id": goods_id, "quantity": goods["quantity"]})
+        
+        failed = sum(1 for r in results if not r["ok"])
+        if failed and mode == "atomic":
+            conn.rollback()
+            # 整批已回滚，原本成功的行同样未生效，不再返回其库存
+            results = [
+                {"ok": False, "id": r["id"], "error": "已回滚"} if r["ok"] else r
+                for r in results
+            ]
+            return jsonify({"success": False, "applied": 0, "failed": failed, "results": results}), 400
+        
+        # 历史记录在同一事务中批量写入
+        cursor.executemany(
+            'INSERT INTO history (goods_id, goods_name, operation_type, quantity, notes, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+            history_rows
+        )
+        conn.commit()
+    finally:
         conn.close()
-        return jsonify({"error": f"库存不足，当前库存: {goods['quantity']}"}), 400
-    
-    new_quantity = goods["quantity"] - quantity
-    cursor.execute('UPDATE goods SET quantity = ?, stock = ?, updated_at = ? WHERE id = ?',
-                   (new_quantity, new_quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), goods_id))
-    conn.commit()
     
-    # 记录操作历史
-    add_history_record(
-        goods["name"],
-        "出库",
-        -quantity,
-        post_data.get("notes", "")
-    )
-    
-    # 获取更新后的数据
-    cursor.execute('SELECT * FROM goods WHERE id = ?', (goods_id,))
-    updated_goods = cursor.fetchone()
-    conn.close()
-    
-    return jsonify({
-        "success": True,
-        "goods": {
-            "id": updated_goods["id"],
-            "_id": str(updated_goods["id"]),
-            "name": updated_goods["name"],
-            "price": updated_goods["price"],
-            "location": updated_goods["location"],
-            "quantity": updated_goods["quantity"],
-            "stock": updated_goods["stock"],
-            "min_quantity": updated_goods["min_quantity"],
-            "description": updated_goods["description"],
-            "created_at": updated_goods["created_at"],
-            "updated_at": updated_goods["updated_at"]
-        }
-    })
+    return jsonify({"success": True, "applied": len(history_rows), "failed": failed, "results": results})
 
 
 # ============ 查询API ============
@@ -622,33 +3285,203 @@ def get_price(goods_id):
     })
 
 
-# 获取低库存货物
+# 获取低库存货物（读取未解除的告警，代价与告警数成正比）
 @app.route('/api/goods/low_stock', methods=['GET'])
 def get_low_stock():
+    try:
+        columns = requested_columns("goods", GOODS_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return stream_rows_response(
+        "goods",
+        '''SELECT goods.* FROM alerts JOIN goods ON goods.id = alerts.goods_id
+           WHERE alerts.status = 'open' ORDER BY alerts.goods_id''',
+        (), goods_to_dict, columns=columns and columns["goods"]
+    )
+
+
+# 低库存告警列表，status: open（默认）| resolved | all
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    status = request.args.get('status', 'open')
+    if status not in ('open', 'resolved', 'all'):
+        return jsonify({"error": "status 只能是 open、resolved 或 all"}), 400
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit 格式错误"}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit 必须大于0"}), 400
+    limit = min(limit, HISTORY_PAGE_MAX)
+    
+    where = "" if status == "all" else "WHERE alerts.status = ?"
+    params = [] if status == "all" else [status]
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM goods WHERE quantity <= min_quantity ORDER BY id')
-    rows = cursor.fetchall()
+    rows = conn.execute(f'''
+        SELECT alerts.*, goods.name FROM alerts LEFT JOIN goods ON goods.id = alerts.goods_id
+        {where} ORDER BY alerts.id DESC LIMIT ?
+    ''', params + [limit]).fetchall()
+    conn.close()
+    return jsonify({"alerts": [alert_to_dict(row) for row in rows]})
+
+
+# ============ 统计API ============
+
+# 库存总值、总数量（汇总各位置，代价与位置数成正比）
+@app.route('/api/stats/inventory', methods=['GET'])
+def get_inventory_stats():
+    conn = snapshot_connection() or get_db_connection()
+    row = conn.execute('''
+        SELECT COALESCE(SUM(goods_count), 0) AS goods_count,
+               COALESCE(SUM(total_quantity), 0) AS total_quantity,
+               COALESCE(SUM(total_value), 0) AS total_value,
+               COUNT(*) AS locations
+        FROM stats_location WHERE goods_count > 0
+    ''').fetchone()
     conn.close()
     
-    goods_list = []
-    for row in rows:
-        goods = {
-            "id": row["id"],
-            "_id": str(row["id"]),
-            "name": row["name"],
-            "price": row["price"],
-            "location": row["location"],
-            "quantity": row["quantity"],
-            "stock": row["stock"],
-            "min_quantity": row["min_quantity"],
-            "description": row["description"],
-            "created_at": row["created_at"],
-            "updated_at": row["updated_at"]
-        }
-        goods_list.append(goods)
+    return jsonify({
+        "goods_count": row["goods_count"],
+        "total_quantity": row["total_quantity"],
+        "total_value": round(row["total_value"], 2),
+        "locations": row["locations"]
+    })
+
+
+# 按位置汇总库存
+@app.route('/api/stats/locations', methods=['GET'])
+def get_location_stats():
+    conn = snapshot_connection() or get_db_connection()
+    rows = conn.execute(
+        'SELECT * FROM stats_location WHERE goods_count > 0 ORDER BY location'
+    ).fetchall()
+    conn.close()
+    
+    return jsonify({"locations": [{
+        "location": row["location"],
+        "goods_count": row["goods_count"],
+        "total_quantity": row["total_quantity"],
+        "total_value": round(row["total_value"], 2)
+    } for row in rows]})
+
+
+# 按天/小时汇总出入库量，granularity=day|hour，from/to 同历史记录查询
+@app.route('/api/stats/movements', methods=['GET'])
+def get_movement_stats():
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ('day', 'hour'):
+        return jsonify({"error": "granularity 只能是 day 或 hour"}), 400
+    
+    # 汇总表按 'YYYY-MM-DD HH' 存储，时间边界截取到小时后比较
+    conditions = []
+    params = []
+    try:
+        if request.args.get('from'):
+            op, value = parse_time_bound(request.args['from'])
+            conditions.append(f"hour {op} ?")
+            params.append(value[:13])
+        if request.args.get('to'):
+            op, value = parse_time_bound(request.args['to'], upper=True)
+            conditions.append(f"hour {op} ?")
+            params.append(value[:13])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    bucket = "substr(hour, 1, 10)" if granularity == 'day' else "hour"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = snapshot_connection() or get_db_connection()
+    rows = conn.execute(f'''
+        SELECT {bucket} AS bucket,
+               SUM(CASE WHEN operation_type = '入库' THEN quantity ELSE 0 END) AS in_quantity,
+               SUM(CASE WHEN operation_type = '入库' THEN movements ELSE 0 END) AS in_count,
+               SUM(CASE WHEN operation_type = '出库' THEN quantity ELSE 0 END) AS out_quantity,
+               SUM(CASE WHEN operation_type = '出库' THEN movements ELSE 0 END) AS out_count
+        FROM stats_movement_hourly {where}
+        GROUP BY 1 ORDER BY 1
+    ''', params).fetchall()
+    conn.close()
+    
+    return jsonify({"granularity": granularity, "buckets": [dict(row) for row in rows]})
+
+
+# ============ 增量同步API ============
+
+# 获取自 since 以来新增、修改和删除的货物与历史记录
+# 返回的 next 作为下一次同步的 since，has_more 为 true 时应立即继续同步
+@app.route('/api/sync', methods=['GET'])
+def sync():
+    try:
+        since = int(request.args.get('since', 0) or 0)
+        limit = int(request.args.get('limit', SYNC_PAGE_SIZE) or SYNC_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "since 或 limit 格式错误"}), 400
+    if since < 0 or limit <= 0:
+        return jsonify({"error": "since 或 limit 超出范围"}), 400
+    limit = min(limit, SYNC_PAGE_MAX)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # 变更和数据在同一个读事务中读取，保证快照一致
+    conn.execute('BEGIN')
+    cursor.execute(
+        'SELECT seq, entity, entity_id, deleted FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+        (since, limit + 1)
+    )
+    changes = cursor.fetchall()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    
+    data = {
+        "goods": [],
+        "history": [],
+        "deleted": {table: [] for table in SYNC_TABLES},
+        "next": str(changes[-1]["seq"]) if changes else str(since),
+        "has_more": has_more
+    }
+    serializers = {"goods": goods_to_dict, "history": history_to_dict}
+    for table in SYNC_TABLES:
+        ids = [c["entity_id"] for c in changes if c["entity"] == table and not c["deleted"]]
+        data["deleted"][table] = [c["entity_id"] for c in changes if c["entity"] == table and c["deleted"]]
+        # 分批 IN 查询，避免超过 SQLite 参数个数上限
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor.execute(
+                f"SELECT * FROM {table} WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id", chunk
+            )
+            data[table].extend(serializers[table](row) for row in cursor.fetchall())
+    conn.commit()
+    conn.close()
     
-    return jsonify({"goods": goods_list})
+    if wants_columnar():
+        return list_response(data, {"goods": GOODS_COMPACT_FIELDS, "history": HISTORY_COMPACT_FIELDS})
+    return jsonify(data)
+
+
+# ============ 实时事件API ============
+
+# 订阅变更事件（SSE）：goods.created/updated/deleted、stock.moved、stock.low
+# 断线重连时浏览器会带上 Last-Event-ID，也可以用 last_event_id 参数指定起点
+@app.route('/api/events', methods=['GET'])
+def events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        seq = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID 格式错误"}), 400
+    
+    event_broker.start()
+    with event_broker.condition:
+        if event_broker.subscribers >= EVENTS_MAX_CLIENTS:
+            return jsonify({"error": "订阅连接过多，请稍后重试"}), 503
+        event_broker.subscribers += 1
+    
+    response = Response(iter_events(event_broker.last_seq if seq is None else seq), mimetype='text/event-stream')
+    # 名额在响应关闭时释放：HEAD 请求或客户端在第一块之前断开时生成器不会执行，finally 不会运行，
+    # 服务器总会调用 close
+    response.call_on_close(release_subscriber)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 # ============ 操作历史API ============
@@ -656,95 +3489,186 @@ def get_low_stock():
 # 获取操作历史
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    data = load_history()
-    return jsonify(data)
+    try:
+        columns = requested_columns("history", HISTORY_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if not any(param in request.args for param in HISTORY_PAGE_PARAMS):
+        return stream_rows_response("history", 'SELECT * FROM history ORDER BY id DESC', (), history_to_dict,
+                                    columns=columns and columns["history"], conn=snapshot_connection())
+    
+    try:
+        data = query_history_page(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(data, columns)
+
+
+# 获取单个货物的操作历史（按时间倒序分页）
+@app.route('/api/goods/<int:goods_id>/history', methods=['GET'])
+def get_goods_history(goods_id):
+    try:
+        columns = requested_columns("history", HISTORY_COMPACT_FIELDS)
+        data = query_history_page(request.args, goods_id=goods_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return list_response(data, columns)
 
 
 # 筛选历史记录
 @app.route('/api/history/search', methods=['GET'])
 def search_history():
     query = request.args.get('q', '').strip()
-    data = load_history()
+    try:
+        columns = requested_columns("history", HISTORY_COMPACT_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     if not query:
-        return jsonify(data)
-    
-    results = [h for h in data["history"] if query.lower() in h["goods_name"].lower()]
-    return jsonify({"history": results})
+        data = load_history()
+        return list_response(data, columns)
+    
+    try:
+        rows, next_offset = search_rows("history", query, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    data = {"history": [history_to_dict(row) for row in rows]}
+    if 'limit' in request.args:
+        data["next_offset"] = next_offset
+    return list_response(data, columns)
 
 
 # 删除历史记录
 @app.route('/api/history/<int:record_id>', methods=['DELETE'])
 def delete_history_record(record_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM history WHERE id = ?', (record_id,))
-    record = cursor.fetchone()
-    
-    if not record:
-        conn.close()
-        return jsonify({"error": "记录不存在"}), 404
-    
-    deleted_record = {
-        "id": record["id"],
-        "_id": str(record["id"]),
-        "goods_name": record["goods_name"],
-        "operation_type": record["operation_type"],
-        "quantity": record["quantity"],
-        "notes": record["notes"],
-        "timestamp": record["timestamp"],
-        "time": record["timestamp"]
-    }
-    
-    cursor.execute('DELETE FROM history WHERE id = ?', (record_id,))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"success": True, "record": deleted_record})
+    return delete_history_by_id(record_id)
 
 
 # 根据 _id 删除历史记录（兼容小程序）
 @app.route('/api/history/by/_id/<string:record_id>', methods=['DELETE'])
 def delete_history_record_by_uuid(record_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM history WHERE id = ?', (record_id,))
-    record = cursor.fetchone()
-    
-    if not record:
-        conn.close()
+    record_id = resolve_id(record_id)
+    if record_id is None:
         return jsonify({"error": "记录不存在"}), 404
-    
-    deleted_record = {
-        "id": record["id"],
-        "_id": str(record["id"]),
-        "goods_name": record["goods_name"],
-        "operation_type": record["operation_type"],
-        "quantity": record["quantity"],
-        "notes": record["notes"],
-        "timestamp": record["timestamp"],
-        "time": record["timestamp"]
-    }
-    
-    cursor.execute('DELETE FROM history WHERE id = ?', (record_id,))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"success": True, "record": deleted_record})
+    return delete_history_by_id(record_id)
 
 
 # 清空所有历史记录
 @app.route('/api/history/clear', methods=['DELETE'])
 def clear_history():
+    return delete_history_response([], [], {})
+
+
+# 按条件批量删除历史记录，请求体: {"from", "to", "goods_id", "op"}，至少提供一个条件
+@app.route('/api/history/delete', methods=['POST'])
+def delete_history_filtered():
+    post_data = request.get_json() or {}
+    if not isinstance(post_data, dict):
+        return jsonify({"error": "请求体必须是对象"}), 400
+    filters = {k: v for k, v in post_data.items() if k in ('from', 'to', 'goods_id', 'op') and v}
+    if not filters:
+        return jsonify({"error": "至少需要一个筛选条件，清空全部请使用 /api/history/clear"}), 400
+    # from/to/op 与查询参数一样只接受字符串
+    for key in ('from', 'to', 'op'):
+        if key in filters and not isinstance(filters[key], str):
+            return jsonify({"error": f"{key} 必须是字符串"}), 400
+    try:
+        goods_id = int(filters["goods_id"]) if "goods_id" in filters else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "goods_id 格式错误"}), 400
+    try:
+        conditions, params = history_filters(filters, goods_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return delete_history_response(conditions, params, filters)
+
+
+# 归档早于 days 天的历史记录（后台任务），请求体: {"days"}
+@app.route('/api/history/archive', methods=['POST'])
+def archive_history_api():
+    post_data = request.get_json(silent=True) or {}
+    try:
+        days = int(post_data.get("days", HISTORY_RETENTION_DAYS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "days 格式错误"}), 400
+    if days < 0:
+        return jsonify({"error": "days 不能小于0"}), 400
+    
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    conn = get_db_connection()
+    total = conn.execute('SELECT COUNT(*) FROM history WHERE timestamp < ?', (cutoff,)).fetchone()[0]
+    conn.close()
+    
+    job_id = start_job("archive_history", {"days": days}, total, archive_history, days)
+    return jsonify({"success": True, "job": get_job(job_id)}), 202
+
+
+# ============ 后台任务API ============
+
+# 最近的后台任务
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    conn = get_db_connection()
+    expire_stale_jobs(conn)
+    rows = conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT 20').fetchall()
+    conn.close()
+    return jsonify({"jobs": [job_to_dict(row) for row in rows]})
+
+
+# 查询任务进度
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job)
+
+
+# 取消任务（在当前批次提交后停止）
+@app.route('/api/jobs/<int:job_id>', methods=['DELETE'])
+def cancel_job(job_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM history')
+    cursor.execute(
+        "UPDATE jobs SET status = 'cancelling', updated_at = ? WHERE id = ? AND status = 'running'",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id)
+    )
     conn.commit()
     conn.close()
-    return jsonify({"success": True})
+    
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify({"success": True, "job": job})
+
+
+# ============ 快照API ============
+
+# 最新快照的生成时间和大小
+@app.route('/api/snapshot', methods=['GET'])
+def get_snapshot():
+    conn = open_snapshot()
+    if conn is None:
+        return jsonify({"error": "快照不存在"}), 404
+    snapshot = snapshot_info(conn)
+    conn.close()
+    snapshot["size"] = os.path.getsize(SNAPSHOT_PATH)
+    return jsonify(snapshot)
+
+
+# 立即刷新快照（后台任务），进度按已复制的页数计
+@app.route('/api/snapshot', methods=['POST'])
+def refresh_snapshot():
+    conn = get_db_connection()
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    conn.close()
+    
+    job_id = start_job("snapshot", {}, pages, backup_database, SNAPSHOT_PATH)
+    return jsonify({"success": True, "job": get_job(job_id)}), 202
 
 
+# 开发服务器；生产环境使用 gunicorn -c gunicorn.conf.py（见 wsgi.py）
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=PORT)
+    create_app().run(debug=True, host='0.0.0.0', port=PORT)
@@ -0,0 +1,307 @@
+"""ASGI 入口：uvicorn asgi:app --workers 2 --timeout-graceful-shutdown 10
+
+所有路由仍由 app.py 中的 Flask 应用处理（URL 与 JSON 完全相同），在有界线程池中执行，
+等待线程的请求只占用一个协程；/api/events 的 SSE 连接在事件循环中直接推送，不占用线程。
+uvicorn 关闭时会等待所有连接结束，SSE 连接不会自行结束，需要用 --timeout-graceful-shutdown 限定等待时间。
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+from urllib.parse import parse_qs
+
+import app as warehouse
+
+# 执行 Flask 请求的线程数（同时在处理中的请求数上限），以及 SSE 订阅连接数上限
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+ASGI_EVENTS_MAX_CLIENTS = int(os.environ.get('ASGI_EVENTS_MAX_CLIENTS', 5000))
+
+# 请求体超过该大小时写入临时文件（导入接口可能上传大文件）
+ASGI_BODY_SPOOL_SIZE = 1024 * 1024
+
+# 工作线程等待事件循环发送响应块时，每隔多久（秒）检查一次客户端是否已断开、服务是否正在关闭
+ASGI_SEND_POLL = 0.5
+
+
+class ClientGone(Exception):
+    """客户端已断开或服务正在关闭，工作线程停止发送响应"""
+
+
+class EventNotifier:
+    """把事件轮询线程的通知转成 asyncio 事件，唤醒所有等待中的 SSE 协程"""
+    
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+    
+    def notify(self):
+        """在轮询线程中调用"""
+        self.loop.call_soon_threadsafe(self._wake)
+    
+    def _wake(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+
+class AsgiApp:
+    """把 Flask WSGI 应用包装为 ASGI 应用，并以协程方式提供 SSE"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi")
+        self.notifier = None
+        self.subscribers = 0
+        self.startup_lock = None
+        self.closing = False
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            # 服务器不支持 lifespan 时在第一个请求前初始化
+            if self.notifier is None:
+                await self.startup()
+            seq = self.events_request(scope)
+            if seq is not False:
+                await self.stream_events(seq, receive, send)
+            else:
+                await self.call_wsgi(scope, receive, send)
+    
+    async def startup(self):
+        """初始化数据库和后台线程（每个进程一次），并订阅事件轮询线程的通知"""
+        if self.startup_lock is None:
+            self.startup_lock = asyncio.Lock()
+        async with self.startup_lock:
+            if self.notifier is not None:
+                return
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, warehouse.create_app)
+            notifier = EventNotifier(loop)
+            warehouse.event_broker.listeners.append(notifier.notify)
+            self.notifier = notifier
+    
+    async def lifespan(self, receive, send):
+        """启动时初始化；关闭时结束 SSE 连接并关闭数据库连接"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # 工作线程发送响应块要等事件循环，不能在事件循环里阻塞等待线程池；
+                # closing 让还在发送的线程尽快退出，未开始的请求直接取消
+                self.closing = True
+                warehouse.event_broker.close()
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, partial(self.executor.shutdown, cancel_futures=True))
+                warehouse.close_all_connections()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    # ============ WSGI 桥接 ============
+    
+    async def call_wsgi(self, scope, receive, send):
+        """读取请求体后在线程池中执行 Flask 应用，响应块经事件循环逐块发送"""
+        body = tempfile.SpooledTemporaryFile(max_size=ASGI_BODY_SPOOL_SIZE)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return
+            body.write(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body.seek(0)
+        
+        loop = asyncio.get_running_loop()
+        environ = self.build_environ(scope, body)
+        # 请求体已读完，之后 receive() 只会返回 http.disconnect；本协程被取消（服务关闭超时）也视为断开
+        gone = threading.Event()
+        watcher = asyncio.ensure_future(self.wait_disconnect(receive))
+        watcher.add_done_callback(lambda _: gone.set())
+        try:
+            await loop.run_in_executor(self.executor, self.run_wsgi, environ, send, loop, gone)
+        except ClientGone:
+            pass
+        finally:
+            gone.set()
+            watcher.cancel()
+            body.close()
+    
+    def run_wsgi(self, environ, send, loop, gone):
+        """在工作线程中执行 Flask 应用；每发送一块都等待事件循环完成，慢客户端会反压生成器
+        
+        客户端断开或服务关闭后发送会抛出 ClientGone，生成器随之关闭，不再占用线程。
+        """
+        def send_sync(message):
+            if gone.is_set() or self.closing:
+                raise ClientGone()
+            future = asyncio.run_coroutine_threadsafe(send(message), loop)
+            while True:
+                try:
+                    return future.result(timeout=ASGI_SEND_POLL)
+                except FutureTimeoutError:
+                    if gone.is_set() or self.closing:
+                        future.cancel()
+                        raise ClientGone()
+        
+        response = {}
+        
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(' ', 1)[0])
+            response["headers"] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: send_body(data)
+        
+        def send_body(data):
+            if "started" not in response:
+                send_sync({"type": "http.response.start", "status": response["status"],
+                           "headers": response["headers"]})
+                response["started"] = True
+            if data:
+                send_sync({"type": "http.response.body", "body": data, "more_body": True})
+        
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                send_body(chunk)
+            send_body(b"")
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        send_sync({"type": "http.response.body", "body": b"", "more_body": False})
+    
+    @staticmethod
+    def build_environ(scope, body):
+        """按 PEP 3333 从 ASGI scope 构造 WSGI environ"""
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": root_path.encode('utf-8').decode('latin-1'),
+            "PATH_INFO": path.encode('utf-8').decode('latin-1'),
+            "QUERY_STRING": scope.get("query_string", b"").decode('latin-1'),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[name] = value
+                continue
+            key = "HTTP_" + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+    
+    # ============ SSE ============
+    
+    @staticmethod
+    def events_request(scope):
+        """是 /api/events 订阅请求时返回起始 seq（None 表示从最新开始），否则返回 False
+        
+        Last-Event-ID 格式错误的请求交给 Flask 路由返回 400。
+        """
+        if scope["method"] != "GET" or scope["path"] != "/api/events":
+            return False
+        headers = dict(scope.get("headers", []))
+        last_event_id = headers.get(b"last-event-id", b"").decode('latin-1')
+        if not last_event_id:
+            last_event_id = parse_qs(scope.get("query_string", b"").decode('latin-1')).get("last_event_id", [""])[0]
+        if not last_event_id:
+            return None
+        try:
+            return int(last_event_id)
+        except ValueError:
+            return False
+    
+    async def stream_events(self, seq, receive, send):
+        """以协程推送 SSE 事件，事件内容和格式与 Flask 路由相同"""
+        loop = asyncio.get_running_loop()
+        if self.subscribers >= ASGI_EVENTS_MAX_CLIENTS:
+            await self.send_json(send, 503, {"error": "订阅连接过多，请稍后重试"})
+            return
+        await loop.run_in_executor(self.executor, warehouse.event_broker.start)
+        if seq is None:
+            seq = warehouse.event_broker.last_seq
+        
+        # 客户端断开时 receive() 返回 http.disconnect
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        self.subscribers += 1
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"access-control-allow-origin", b"*"),
+            ]})
+            await self.send_chunk(send, "retry: 3000\n\n")
+            while not disconnected.done() and not warehouse.event_broker.closed:
+                wakeup = self.notifier.event
+                events = warehouse.event_broker.events_after(seq)
+                if events is None:
+                    events = await loop.run_in_executor(self.executor, warehouse.load_events_after, seq)
+                if events is None:
+                    seq = warehouse.event_broker.last_seq
+                    await self.send_chunk(send, f"id: {seq}\nevent: reset\ndata: {{}}\n\n")
+                    continue
+                
+                if events:
+                    await self.send_chunk(send, ''.join(
+                        f"id: {event_seq}\nevent: {event_type}\ndata: {data}\n\n"
+                        for event_seq, event_type, data in events
+                    ))
+                    seq = events[-1][0]
+                    continue
+                
+                woken = asyncio.ensure_future(wakeup.wait())
+                done, _ = await asyncio.wait({disconnected, woken}, timeout=warehouse.EVENTS_KEEPALIVE,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if not done:
+                    await self.send_chunk(send, ": keepalive\n\n")
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.subscribers -= 1
+            disconnected.cancel()
+    
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+    
+    @staticmethod
+    async def send_chunk(send, text):
+        await send({"type": "http.response.body", "body": text.encode('utf-8'), "more_body": True})
+    
+    @staticmethod
+    async def send_json(send, status, data):
+        """返回与 jsonify 相同格式的 JSON 响应"""
+        with warehouse.app.app_context():
+            body = warehouse.jsonify(data).get_data()
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"access-control-allow-origin", b"*"),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+
+app = AsgiApp(warehouse.app)
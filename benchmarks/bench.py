@@ -0,0 +1,321 @@
+"""接口基准测试：生成合成数据库，用并发客户端按小程序的访问比例压测真实路由
+
+用法：
+    # 生成 10 万货物、500 万历史记录的数据库（只需一次），进程内压测 30 秒，结果写入 JSON
+    python benchmarks/bench.py --db /tmp/bench.db --goods 100000 --history 5000000 --seed-only
+    python benchmarks/bench.py --db /tmp/bench.db --clients 16 --duration 30 --out results.json
+    
+    # 压测已启动的服务（服务通过 WAREHOUSE_DB 使用同一个数据库）
+    WAREHOUSE_DB=/tmp/bench.db gunicorn -c gunicorn.conf.py
+    python benchmarks/bench.py --db /tmp/bench.db --url http://127.0.0.1:5000 --out results.json
+    
+    # 与上一次的结果对比
+    python benchmarks/bench.py --db /tmp/bench.db --out new.json --compare results.json
+
+全程离线：进程内模式使用 Flask 测试客户端，HTTP 模式只访问 --url 指定的服务。
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as warehouse  # noqa: E402
+
+# 合成数据的名称和位置
+NOUNS = ["螺丝", "螺母", "垫片", "轴承", "弹簧", "销钉", "铆钉", "卡箍", "法兰", "接头"]
+MATERIALS = ["不锈钢", "碳钢", "黄铜", "铝合金", "尼龙"]
+LOCATIONS = [f"{zone}-{shelf:02d}" for zone in "ABCDEFGH" for shelf in range(1, 26)]
+
+# 默认访问比例：浏览（分页列表）、搜索、详情、出入库、货物历史
+DEFAULT_MIX = "browse=40,search=20,detail=25,stock=10,history=5"
+
+SEED_BATCH = 50000
+
+
+def goods_name(i):
+    """第 i 个货物的名称，名称唯一，便于迁移时按名称回填历史记录的 goods_id"""
+    return f"{MATERIALS[i % len(MATERIALS)]}{NOUNS[i // len(MATERIALS) % len(NOUNS)]} M{i % 97 + 2}-{i}"
+
+
+def seed(db_path, goods_count, history_count, days):
+    """生成合成数据库：先按 v1 表结构批量写入，再执行全部迁移生成索引、汇总表、检索表等"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    rng = random.Random(42)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    warehouse.migrate_base_tables(conn.cursor())
+    conn.execute('PRAGMA user_version = 1')
+    now = datetime.now()
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    
+    start = time.perf_counter()
+    for offset in range(0, goods_count, SEED_BATCH):
+        rows = []
+        for i in range(offset, min(offset + SEED_BATCH, goods_count)):
+            quantity = rng.randint(0, 5000)
+            rows.append((goods_name(i), round(rng.uniform(0.05, 500), 2), LOCATIONS[i % len(LOCATIONS)],
+                         quantity, quantity, rng.choice((0, 10, 50, 100)), "", timestamp, timestamp))
+        conn.executemany(
+            '''INSERT INTO goods (name, price, location, quantity, stock, min_quantity, description, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows
+        )
+        conn.commit()
+    
+    # 历史记录按时间顺序写入，时间均匀分布在最近 days 天内
+    span = days * 86400
+    for offset in range(0, history_count, SEED_BATCH):
+        rows = []
+        for i in range(offset, min(offset + SEED_BATCH, history_count)):
+            when = now - timedelta(seconds=span * (1 - i / max(history_count, 1)))
+            inbound = rng.random() < 0.5
+            quantity = rng.randint(1, 50)
+            rows.append((goods_name(rng.randrange(goods_count)), "入库" if inbound else "出库",
+                         quantity if inbound else -quantity, "", when.strftime("%Y-%m-%d %H:%M:%S")))
+        conn.executemany(
+            'INSERT INTO history (goods_name, operation_type, quantity, notes, timestamp) VALUES (?, ?, ?, ?, ?)', rows
+        )
+        conn.commit()
+    conn.close()
+    print(f"写入 {goods_count} 条货物、{history_count} 条历史记录: {time.perf_counter() - start:.1f}s")
+    
+    start = time.perf_counter()
+    warehouse.DB_PATH = db_path
+    warehouse.init_db()
+    warehouse.close_all_connections()
+    print(f"执行迁移并建立索引: {time.perf_counter() - start:.1f}s")
+
+
+class InProcessClient:
+    """进程内客户端（Flask 测试客户端），每个压测线程一个"""
+    
+    def __init__(self):
+        self.client = warehouse.app.test_client()
+    
+    def request(self, method, path, body=None):
+        resp = self.client.open(path, method=method, json=body)
+        resp.get_data()
+        return resp.status_code
+
+
+class HttpClient:
+    """HTTP 长连接客户端，每个压测线程一个"""
+    
+    def __init__(self, url):
+        self.netloc = urlsplit(url).netloc
+        self.conn = http.client.HTTPConnection(self.netloc, timeout=60)
+    
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        try:
+            self.conn.request(method, path, data, headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException):
+            # 服务端关闭了长连接，重新连接后计为一次失败
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.netloc, timeout=60)
+            return 599
+        return resp.status
+
+
+def make_request(kind, rng, goods_count):
+    """按场景生成一次请求，返回 (统计用的接口名, 方法, 路径, 请求体)"""
+    goods_id = rng.randint(1, goods_count)
+    if kind == "browse":
+        return "GET /api/goods?after_id&limit", "GET", f"/api/goods?after_id={goods_id}&limit=50", None
+    if kind == "search":
+        # 材料+名称走全文检索；两个字的名称短于 trigram，走 LIKE 扫描
+        q = rng.choice(NOUNS)
+        if rng.random() < 0.7:
+            q = rng.choice(MATERIALS) + q
+        return "GET /api/goods/search", "GET", f"/api/goods/search?q={quote(q)}", None
+    if kind == "detail":
+        return "GET /api/goods/by/_id/<id>", "GET", f"/api/goods/by/_id/{goods_id}", None
+    if kind == "stock":
+        op = "stock_in" if rng.random() < 0.5 else "stock_out"
+        return f"POST /api/goods/<id>/{op}", "POST", f"/api/goods/{goods_id}/{op}", {"quantity": 1}
+    if kind == "history":
+        return "GET /api/goods/<id>/history", "GET", f"/api/goods/{goods_id}/history?limit=20", None
+    raise ValueError(f"未知场景: {kind}")
+
+
+def worker(client, mix, goods_count, seed_value, warmup_until, deadline, samples):
+    """按权重随机选择场景并记录每次请求的耗时；预热期间的请求不计入结果"""
+    rng = random.Random(seed_value)
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        endpoint, method, path, body = make_request(rng.choices(kinds, weights)[0], rng, goods_count)
+        start = time.perf_counter()
+        status = client.request(method, path, body)
+        elapsed = time.perf_counter() - start
+        if now >= warmup_until:
+            # 库存不足的出库（400）是正常业务结果，不计为错误
+            samples.append((endpoint, elapsed, status >= 500 or status in (404, 405)))
+
+
+def percentile(sorted_values, p):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples, duration):
+    """按接口汇总请求数、吞吐和延迟百分位（毫秒）"""
+    by_endpoint = {}
+    for endpoint, elapsed, error in samples:
+        entry = by_endpoint.setdefault(endpoint, {"latencies": [], "errors": 0})
+        entry["latencies"].append(elapsed * 1000)
+        entry["errors"] += error
+    
+    results = {
+        endpoint: latency_stats(entry["latencies"], entry["errors"], duration)
+        for endpoint, entry in sorted(by_endpoint.items())
+    }
+    results["ALL"] = latency_stats([elapsed * 1000 for _, elapsed, _ in samples],
+                                   sum(error for _, _, error in samples), duration)
+    return results
+
+
+def latency_stats(latencies, errors, duration):
+    """一组请求的统计结果"""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def print_results(results, baseline=None):
+    """打印结果表；传入上一次的结果时附加吞吐和 p95 的变化"""
+    header = f"{'接口':<36}{'请求数':>9}{'错误':>7}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header + ("   Δreq/s    Δp95" if baseline else ""))
+    for endpoint, r in results.items():
+        line = (f"{endpoint:<38}{r['requests']:>9}{r['errors']:>7}{r['rps']:>10}"
+                f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+        old = (baseline or {}).get(endpoint)
+        if old:
+            line += f"   {change(old['rps'], r['rps']):>7}  {change(old['p95_ms'], r['p95_ms']):>7}"
+        print(line)
+
+
+def change(old, new):
+    """相对变化百分比"""
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def parse_mix(text):
+    """解析 browse=40,search=20 形式的访问比例"""
+    mix = []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'warehouse_bench.db'),
+                        help="合成数据库路径，不存在或指定 --reseed 时重新生成")
+    parser.add_argument('--goods', type=int, default=10000, help="货物数")
+    parser.add_argument('--history', type=int, default=100000, help="历史记录数")
+    parser.add_argument('--days', type=int, default=365, help="历史记录的时间跨度（天）")
+    parser.add_argument('--reseed', action='store_true', help="重新生成数据库")
+    parser.add_argument('--seed-only', action='store_true', help="只生成数据库，不压测")
+    parser.add_argument('--url', help="压测已启动的服务；不指定时在进程内压测")
+    parser.add_argument('--clients', type=int, default=16, help="并发客户端数")
+    parser.add_argument('--duration', type=float, default=30, help="计入结果的压测时长（秒）")
+    parser.add_argument('--warmup', type=float, default=3, help="预热时长（秒），不计入结果")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"访问比例，默认 {DEFAULT_MIX}")
+    parser.add_argument('--out', help="把结果写入 JSON 文件")
+    parser.add_argument('--compare', help="与之前写出的 JSON 结果对比")
+    args = parser.parse_args()
+    
+    if args.reseed or not os.path.exists(args.db):
+        seed(args.db, args.goods, args.history, args.days)
+    if args.seed_only:
+        return
+    
+    warehouse.DB_PATH = args.db
+    warehouse.create_app()
+    conn = warehouse.get_db_connection()
+    goods_count = conn.execute('SELECT MAX(id) FROM goods').fetchone()[0] or 1
+    history_count = conn.execute('SELECT MAX(id) FROM history').fetchone()[0] or 0
+    conn.close()
+    
+    mix = parse_mix(args.mix)
+    samples = []
+    warmup_until = time.monotonic() + args.warmup
+    deadline = warmup_until + args.duration
+    threads = []
+    for n in range(args.clients):
+        client = HttpClient(args.url) if args.url else InProcessClient()
+        threads.append(threading.Thread(
+            target=worker, args=(client, mix, goods_count, n, warmup_until, deadline, samples)
+        ))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    results = summarize(samples, args.duration)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+    print(f"{'HTTP ' + args.url if args.url else '进程内'}，{args.clients} 个客户端，{args.duration:.0f}s，"
+          f"货物 {goods_count}，历史记录 {history_count}")
+    print_results(results, baseline)
+    
+    if args.out:
+        report = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "config": {
+                "target": args.url or "in-process",
+                "clients": args.clients,
+                "duration": args.duration,
+                "warmup": args.warmup,
+                "mix": dict(mix),
+                "goods": goods_count,
+                "history": history_count,
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "results": results,
+        }
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.out}")
+
+
+if __name__ == '__main__':
+    main()
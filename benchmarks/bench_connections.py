@@ -0,0 +1,85 @@
+"""连接层基准测试：对比每次请求新建连接（旧实现）与线程内复用 WAL 连接
+
+用法：python benchmarks/bench_connections.py --threads 8 --requests 500
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as warehouse  # noqa: E402
+from common import seed  # noqa: E402
+
+
+def legacy_get_db_connection():
+    """旧实现：每次调用都新建连接，使用默认的回滚日志模式"""
+    conn = sqlite3.connect(warehouse.DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def worker(client, requests, goods_count, offset, errors):
+    """混合负载：一半查询货物详情，一半入库/出库"""
+    for i in range(requests):
+        goods_id = (offset + i) % goods_count + 1
+        if i % 2 == 0:
+            resp = client.get(f'/api/goods/by/_id/{goods_id}')
+        elif i % 4 == 1:
+            resp = client.post(f'/api/goods/{goods_id}/stock_in', json={"quantity": 1})
+        else:
+            resp = client.post(f'/api/goods/{goods_id}/stock_out', json={"quantity": 1})
+        if resp.status_code != 200:
+            errors.append(resp.status_code)
+
+
+def run(mode, threads, requests, goods_count):
+    """在独立的临时数据库上运行一轮并返回每秒请求数"""
+    tmpdir = tempfile.mkdtemp()
+    warehouse.DB_PATH = os.path.join(tmpdir, 'bench.db')
+    warehouse.close_all_connections()
+    
+    original = warehouse.get_db_connection
+    if mode == 'legacy':
+        warehouse.get_db_connection = legacy_get_db_connection
+    try:
+        seed(goods_count)
+        errors = []
+        pool = [
+            threading.Thread(target=worker, args=(warehouse.app.test_client(), requests, goods_count, n * 7, errors))
+            for n in range(threads)
+        ]
+        start = time.perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        warehouse.get_db_connection = original
+        warehouse.close_all_connections()
+    
+    return threads * requests / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连接层吞吐量对比")
+    parser.add_argument('--threads', type=int, default=8, help="并发客户端线程数")
+    parser.add_argument('--requests', type=int, default=500, help="每个线程的请求数")
+    parser.add_argument('--goods', type=int, default=1000, help="测试货物数量")
+    args = parser.parse_args()
+    
+    results = {}
+    for mode in ('legacy', 'pooled'):
+        rps, errors = run(mode, args.threads, args.requests, args.goods)
+        results[mode] = rps
+        print(f"{mode:>7}: {rps:8.1f} req/s  错误 {errors}")
+    print(f"提升: {results['pooled'] / results['legacy']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
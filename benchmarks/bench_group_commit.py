@@ -0,0 +1,101 @@
+"""合并提交基准测试：对比单次入库/出库逐个提交与合并提交（STOCK_GROUP_COMMIT）
+
+进程内每个客户端一个线程，同时对少量热门货物入库/出库，输出吞吐、p50/p99 延迟和每次提交的平均合并数。
+
+用法：
+    python benchmarks/bench_group_commit.py --clients 50,200,1000 --requests 20
+    python benchmarks/bench_group_commit.py --clients 200 --synchronous FULL --window 2
+"""
+import argparse
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as warehouse  # noqa: E402
+from common import seed  # noqa: E402
+
+
+def worker(client, requests, goods_count, offset, start, latencies, errors):
+    """交替入库/出库 1 件"""
+    start.wait()
+    for i in range(requests):
+        goods_id = (offset + i) % goods_count + 1
+        op = 'stock_in' if i % 2 == 0 else 'stock_out'
+        began = time.perf_counter()
+        resp = client.post(f'/api/goods/{goods_id}/{op}', json={"quantity": 1})
+        latencies.append(time.perf_counter() - began)
+        if resp.status_code != 200:
+            errors.append(resp.status_code)
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    return values[max(math.ceil(len(values) * p / 100) - 1, 0)]
+
+
+def run(group_commit, clients, requests, goods_count, window_ms, max_items):
+    """在独立的临时数据库上运行一轮，返回 (req/s, p50, p99, 错误数, 平均每次提交的出入库数)"""
+    warehouse.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    warehouse.close_all_connections()
+    warehouse.STOCK_GROUP_COMMIT = group_commit
+    warehouse.stock_commit_queue = warehouse.StockCommitQueue(window_ms, max_items)
+    seed(goods_count)
+    
+    latencies = []
+    errors = []
+    start = threading.Event()
+    pool = [
+        threading.Thread(target=worker, args=(warehouse.app.test_client(), requests, goods_count, n * 7,
+                                              start, latencies, errors))
+        for n in range(clients)
+    ]
+    for t in pool:
+        t.start()
+    began = time.perf_counter()
+    start.set()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - began
+    
+    # 每个成功的出入库写一条历史记录，除以写线程提交的事务数即为平均合并数
+    conn = warehouse.get_db_connection()
+    movements = conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+    conn.close()
+    groups = warehouse.stock_commit_queue.groups if group_commit else movements
+    
+    latencies.sort()
+    return (clients * requests / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            len(errors), movements / max(groups, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="单次入库/出库合并提交对比")
+    parser.add_argument('--clients', default='50,200,1000', help="并发客户端数，逗号分隔")
+    parser.add_argument('--requests', type=int, default=20, help="每个客户端的请求数")
+    parser.add_argument('--goods', type=int, default=100, help="参与出入库的货物数（越少越集中）")
+    parser.add_argument('--window', type=float, default=warehouse.STOCK_GROUP_WINDOW_MS, help="合并窗口（毫秒）")
+    parser.add_argument('--max', type=int, default=warehouse.STOCK_GROUP_MAX, help="每次最多合并的出入库数")
+    parser.add_argument('--synchronous', default='NORMAL', choices=('NORMAL', 'FULL'),
+                        help="FULL 时每次提交都 fsync，接近不使用 WAL 或要求掉电不丢数据的部署")
+    args = parser.parse_args()
+    
+    warehouse.DB_PRAGMAS = [(k, args.synchronous if k == 'synchronous' else v) for k, v in warehouse.DB_PRAGMAS]
+    
+    print(f"synchronous={args.synchronous} window={args.window}ms max={args.max}")
+    print(f"{'clients':>7} {'mode':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'错误':>5} {'合并数':>6}")
+    for clients in (int(c) for c in args.clients.split(',')):
+        for group_commit in (False, True):
+            rps, p50, p99, errors, per_commit = run(group_commit, clients, args.requests, args.goods,
+                                                    args.window, args.max)
+            mode = 'group' if group_commit else 'single'
+            print(f"{clients:>7} {mode:>6} {rps:8.0f} {p50:8.1f} {p99:8.1f} {errors:>5} {per_commit:6.1f}")
+        warehouse.close_all_connections()
+
+
+if __name__ == '__main__':
+    main()
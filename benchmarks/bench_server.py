@@ -0,0 +1,87 @@
+"""服务器基准测试：通过 HTTP 压测已启动的服务，对比开发服务器（python app.py）与 gunicorn
+
+用法：
+    python benchmarks/bench_server.py --url http://127.0.0.1:5000 --seed 1000
+    python benchmarks/bench_server.py --url http://127.0.0.1:5000 --threads 32 --duration 20
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def seed(url, goods_count):
+    """通过导入接口写入测试货物"""
+    body = ''.join(
+        json.dumps({"name": f"货物{i}", "price": 1.0, "location": f"A-{i % 10}", "quantity": 1000000},
+                   ensure_ascii=False) + '\n'
+        for i in range(goods_count)
+    ).encode('utf-8')
+    conn = http.client.HTTPConnection(urlsplit(url).netloc, timeout=60)
+    conn.request('POST', '/api/goods/import?format=ndjson', body, {"Content-Type": "application/x-ndjson"})
+    resp = conn.getresponse()
+    print(f"导入 {goods_count} 条货物: {resp.status} {resp.read()[:200].decode('utf-8', 'replace')}")
+    conn.close()
+
+
+def worker(url, goods_count, offset, deadline, counts, errors):
+    """混合负载（长连接）：货物详情、货物分页、入库、出库"""
+    conn = http.client.HTTPConnection(urlsplit(url).netloc, timeout=30)
+    i = 0
+    done = 0
+    while time.monotonic() < deadline:
+        goods_id = (offset + i) % goods_count + 1
+        kind = i % 4
+        if kind == 0:
+            conn.request('GET', f'/api/goods/by/_id/{goods_id}')
+        elif kind == 1:
+            conn.request('GET', f'/api/goods?after_id={goods_id}&limit=50')
+        else:
+            body = json.dumps({"quantity": 1})
+            op = 'stock_in' if kind == 2 else 'stock_out'
+            conn.request('POST', f'/api/goods/{goods_id}/{op}', body, {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 200:
+            errors.append(resp.status)
+        done += 1
+        i += 1
+    conn.close()
+    counts.append(done)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--goods', type=int, default=1000, help="压测使用的货物 id 范围")
+    parser.add_argument('--seed', type=int, default=0, help="压测前先导入的货物数")
+    args = parser.parse_args()
+    
+    if args.seed:
+        seed(args.url, args.seed)
+    
+    counts = []
+    errors = []
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(args.url, args.goods, n * 97, deadline, counts, errors))
+        for n in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    
+    total = sum(counts)
+    print(f"{args.threads} 个客户端线程, {elapsed:.1f}s: {total} 次请求, "
+          f"{total / elapsed:.0f} req/s, 错误 {len(errors)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""基准测试共用的辅助函数"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as warehouse  # noqa: E402
+
+
+def seed(goods_count):
+    """初始化数据库并写入测试货物"""
+    warehouse.init_db()
+    conn = warehouse.get_db_connection()
+    conn.executemany(
+        'INSERT INTO goods (name, price, location, quantity, stock) VALUES (?, ?, ?, ?, ?)',
+        [(f"货物{i}", 1.0, f"A-{i % 10}", 1000000, 1000000) for i in range(goods_count)]
+    )
+    conn.commit()
+    conn.close()
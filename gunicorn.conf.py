@@ -0,0 +1,50 @@
+"""gunicorn 配置：多进程 + 多线程运行 wsgi:app
+
+工作进程数、线程数等从环境变量读取；数据库在主进程启动时初始化一次，工作进程不再重复执行迁移。
+"""
+import os
+import signal
+
+wsgi_app = "wsgi:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# SQLite 同一时刻只有一个写事务，进程数不宜过多；读请求和 SSE 连接由线程承载
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+
+# gthread 下每个 SSE 订阅连接（/api/events）一直占用一个线程，每个进程的订阅数必须低于线程数，
+# 否则订阅连接会占满线程，普通接口无法响应。默认只给订阅留 1/4 的线程，至少留一个线程处理普通请求；
+# 需要大量订阅连接（多个看板）时用 ASGI 入口：uvicorn asgi:app
+events_max_clients = min(int(os.environ.get('EVENTS_MAX_CLIENTS', max(threads // 4, 1))), threads - 1)
+
+# 收到 SIGTERM 后等待进行中的请求完成的时间（秒）
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+
+
+def on_starting(server):
+    """主进程启动时执行一次数据库迁移"""
+    import app as warehouse
+    warehouse.prepare_database()
+
+
+def post_worker_init(worker):
+    """限制 SSE 订阅数；工作进程收到 SIGTERM 时先结束 SSE 订阅连接，再交给 gunicorn 平滑关闭"""
+    import app as warehouse
+    warehouse.EVENTS_MAX_CLIENTS = events_max_clients
+    handle_term = signal.getsignal(signal.SIGTERM)
+    
+    def close_streams(signum, frame):
+        warehouse.event_broker.close()
+        if callable(handle_term):
+            handle_term(signum, frame)
+    
+    signal.signal(signal.SIGTERM, close_streams)
+
+
+def worker_exit(server, worker):
+    """工作进程退出时关闭数据库连接（WAL 检查点随最后一个连接关闭完成）"""
+    import app as warehouse
+    warehouse.close_all_connections()
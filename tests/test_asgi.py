@@ -0,0 +1,197 @@
+"""ASGI 前端与 Flask（WSGI）的请求一致性测试
+
+同一组请求分别经 Flask 测试客户端和 asgi.app 在各自的新数据库上依次执行，逐条比较状态码、
+Content-Type 和响应体（时间戳归一化）。每个前端在独立子进程中运行，互不共享缓存和数据库。
+
+用法：
+    python -m pytest tests/test_asgi.py
+"""
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (方法, 路径, JSON 请求体)，按顺序执行，后面的请求依赖前面的修改
+REQUESTS = [
+    ('POST', '/api/goods', {"name": "螺丝", "price": "2", "location": "A", "quantity": "5", "min_quantity": 3,
+                            "description": "d"}),
+    ('POST', '/api/goods', {"name": "螺母", "price": 1.25, "location": "B", "stock": 7}),
+    ('POST', '/api/goods', {"name": "", "price": 1, "location": "B"}),
+    ('GET', '/api/goods', None),
+    ('GET', '/api/goods?limit=1', None),
+    ('GET', '/api/goods/by/_id/1', None),
+    ('GET', '/api/goods/by/_id/99', None),
+    ('PUT', '/api/goods/by/_id/1', {"name": "大螺丝", "stock": 9}),
+    ('PUT', '/api/goods/2', {"price": 3, "quantity": 1, "min_quantity": 2}),
+    ('POST', '/api/goods/1/stock_in', {"quantity": 2, "notes": "n"}),
+    ('POST', '/api/goods/1/stock_out', {"quantity": 20}),
+    ('POST', '/api/stock/batch', {"items": [{"goods_id": 1, "op": "in", "quantity": 1}]}),
+    ('GET', '/api/goods/low_stock', None),
+    ('GET', '/api/goods/search?q=%E8%9E%BA', None),
+    ('GET', '/api/history', None),
+    ('GET', '/api/history?format=ndjson', None),
+    ('GET', '/api/goods/1/history?limit=1', None),
+    ('GET', '/api/events?last_event_id=x', None),
+    ('GET', '/api/stats/inventory', None),
+    ('GET', '/api/goods/export?format=csv', None),
+    ('DELETE', '/api/goods/by/_id/2', None),
+    ('DELETE', '/api/history/clear', None),
+    ('GET', '/api/nope', None),
+]
+
+FRONTENDS = ["wsgi", "asgi"]
+
+TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d')
+
+
+def replay_wsgi():
+    """经 Flask 测试客户端依次发送 REQUESTS，返回 [(状态码, Content-Type, 响应体)]"""
+    import app as warehouse
+    client = warehouse.create_app().test_client()
+    results = []
+    for method, path, body in REQUESTS:
+        response = client.open(path, method=method, json=body)
+        results.append((response.status_code, response.headers.get('Content-Type'), response.get_data()))
+    return results
+
+
+async def asgi_request(app, method, path, body):
+    """以最小的 ASGI 服务器调用 app，返回 (状态码, Content-Type, 响应体)"""
+    path, _, query = path.partition('?')
+    data = json.dumps(body).encode('utf-8') if body is not None else b""
+    headers = [(b"host", b"localhost")]
+    if body is not None:
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+        "method": method, "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": query.encode(), "headers": headers,
+        "server": ("localhost", 80), "client": ("127.0.0.1", 50000),
+    }
+    messages = [{"type": "http.request", "body": data, "more_body": False}]
+    sent = []
+    
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # 响应完成前不会断开
+        await asyncio.Event().wait()
+    
+    async def send(message):
+        sent.append(message)
+    
+    await app(scope, receive, send)
+    start = sent[0]
+    content_type = dict(start["headers"]).get(b"content-type")
+    return (start["status"], content_type.decode('latin-1') if content_type else None,
+            b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+def replay_asgi():
+    """经 asgi.app 依次发送 REQUESTS，返回 [(状态码, Content-Type, 响应体)]"""
+    import asgi
+    
+    async def run():
+        return [await asgi_request(asgi.app, method, path, body) for method, path, body in REQUESTS]
+    
+    return asyncio.run(run())
+
+
+def run_frontend(frontend, directory):
+    """在子进程中用新数据库执行一个前端，返回归一化后的结果列表"""
+    env = dict(os.environ, WAREHOUSE_DB=os.path.join(directory, 'warehouse.db'))
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), frontend],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=120, check=True
+    ).stdout
+    return [tuple(result) for result in json.loads(output.splitlines()[-1])]
+
+
+@pytest.fixture(scope="module")
+def results(tmp_path_factory):
+    return {frontend: run_frontend(frontend, str(tmp_path_factory.mktemp(frontend))) for frontend in FRONTENDS}
+
+
+@pytest.mark.parametrize("index", range(len(REQUESTS)), ids=[f"{m} {p}" for m, p, _ in REQUESTS])
+def test_same_response(results, index):
+    assert results["asgi"][index] == results["wsgi"][index]
+
+
+def endless_wsgi(environ, start_response):
+    """不断产生响应块的 WSGI 应用，模拟慢客户端下的长响应"""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    while True:
+        yield b"x"
+
+
+@pytest.mark.parametrize("stop", ["disconnect", "cancel", "shutdown"])
+def test_blocked_send_does_not_hang_shutdown(monkeypatch, stop):
+    """客户端不再读取时工作线程卡在发送上；断开、请求协程被取消或服务关闭后线程要退出，lifespan 关闭不能卡住事件循环"""
+    sys.path.insert(0, ROOT)
+    import app as warehouse
+    import asgi
+    monkeypatch.setattr(warehouse, "event_broker", warehouse.EventBroker(warehouse.EVENTS_BUFFER_SIZE))
+    monkeypatch.setattr(asgi, "ASGI_SEND_POLL", 0.05)
+    asgi_app = asgi.AsgiApp(endless_wsgi)
+    # 跳过数据库初始化
+    asgi_app.notifier = object()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+        "method": "GET", "path": "/stream", "raw_path": b"/stream", "root_path": "",
+        "query_string": b"", "headers": [(b"host", b"localhost")],
+    }
+    
+    async def run():
+        messages = [{"type": "http.request", "body": b"", "more_body": False}]
+        
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            if stop == "disconnect":
+                await asyncio.sleep(0.1)
+            else:
+                await asyncio.Event().wait()
+            return {"type": "http.disconnect"}
+        
+        async def send(message):
+            # 第一块之后客户端不再读取
+            if message["type"] == "http.response.body":
+                await asyncio.Event().wait()
+        
+        request = asyncio.ensure_future(asgi_app(scope, receive, send))
+        await asyncio.sleep(0.2)
+        if stop == "cancel":
+            request.cancel()
+        lifespan = [{"type": "lifespan.shutdown"}]
+        sent = []
+        
+        async def lifespan_send(message):
+            sent.append(message)
+        
+        await asgi_app.lifespan(lambda: asyncio.sleep(0, lifespan.pop(0)), lifespan_send)
+        request.cancel()
+        return sent
+    
+    # 旧实现会在事件循环中阻塞等待线程池，asyncio 的超时也无法触发，因此在线程中运行并限定等待时间
+    result = []
+    runner = threading.Thread(target=lambda: result.append(asyncio.run(run())), daemon=True)
+    runner.start()
+    runner.join(10)
+    assert not runner.is_alive()
+    assert result == [[{"type": "lifespan.shutdown.complete"}]]
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    replayed = replay_asgi() if sys.argv[1] == "asgi" else replay_wsgi()
+    print(json.dumps([
+        (status, content_type, TIMESTAMP.sub('T', body.decode('utf-8')))
+        for status, content_type, body in replayed
+    ], ensure_ascii=False))
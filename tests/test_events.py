@@ -0,0 +1,46 @@
+"""/api/events 订阅名额测试：HEAD 请求和未读取的响应关闭后都要释放名额
+
+WSGI 服务器在响应结束（包括 HEAD 和客户端提前断开）时总会调用 close，测试客户端不会自动调用，这里显式关闭。
+"""
+import os
+
+import pytest
+
+import app as warehouse
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(warehouse, "DB_PATH", os.path.join(tmp_path, 'warehouse.db'))
+    monkeypatch.setattr(warehouse, "EVENTS_MAX_CLIENTS", 2)
+    warehouse.close_all_connections()
+    warehouse.init_db()
+    yield warehouse.app.test_client()
+    warehouse.close_all_connections()
+
+
+def test_head_does_not_leak_subscriber(client):
+    for _ in range(3):
+        response = client.head('/api/events')
+        assert response.status_code == 200
+        response.close()
+    assert warehouse.event_broker.subscribers == 0
+
+
+def test_unread_stream_does_not_leak_subscriber(client):
+    for _ in range(3):
+        response = client.get('/api/events', buffered=False)
+        assert response.status_code == 200
+        response.close()
+    assert warehouse.event_broker.subscribers == 0
+
+
+def test_limit_applies_to_open_streams(client):
+    streams = [client.get('/api/events', buffered=False) for _ in range(2)]
+    assert client.get('/api/events', buffered=False).status_code == 503
+    for response in streams:
+        response.close()
+    response = client.get('/api/events', buffered=False)
+    assert response.status_code == 200
+    response.close()
+    assert warehouse.event_broker.subscribers == 0
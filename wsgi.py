@@ -0,0 +1,4 @@
+"""WSGI 入口：gunicorn -c gunicorn.conf.py（或其他 WSGI 服务器加载 wsgi:app）"""
+from app import create_app
+
+app = create_app()